@@ -1,6 +1,7 @@
 from __future__ import absolute_import, unicode_literals
 import os
 from celery import Celery
+from celery.signals import task_postrun, worker_init
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'downloader.settings')  # Sets the default DANGO_SETTINGS_MODULE env var to the celery cmd line
 app = Celery('downloader', broker='amqp:guest:guest@localhost:5672/')
@@ -10,6 +11,29 @@ app.conf.update(
     broker_connection_retry_on_startup=True,
 )
 
+@worker_init.connect
+def patch_psycopg_for_gevent(**kwargs):
+    """
+    Lets psycopg2 queries wait on postgres without blocking the other greenlets (celery -P gevent workers)
+    - gevent can't patch the C library itself
+    """
+    from django.conf import settings
+    if settings.DB_ENGINE == 'postgres' and settings.GEVENT_PATCHED:
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+
+
+@task_postrun.connect
+def close_db_connections(**kwargs):
+    """
+    Closes the task's db connections once it is done (returns them to the pool with DB_POOL=gevent)
+    - celery doesn't send django's request_finished signal that does this for views
+    """
+    from django.db import connections
+    for conn in connections.all(initialized_only=True):
+        conn.close()
+
+
 @app.task(bind=True)
 def debug_task(self):
     print(f'Request: {self.request!r}')
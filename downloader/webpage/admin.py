@@ -1,4 +1,11 @@
 from django.contrib import admin
-from .models import VideoLog
+from .models import VideoLog, DownloadJob, RateBucket
 
-admin.site.register(VideoLog)
\ No newline at end of file
+admin.site.register(VideoLog)
+admin.site.register(DownloadJob)
+
+
+@admin.register(RateBucket)
+class RateBucketAdmin(admin.ModelAdmin):
+    # Rate limit metrics (shared by every process - see rate_limit.py)
+    list_display = ('name', 'acquired', 'throttled', 'wait_seconds', 'tokens')
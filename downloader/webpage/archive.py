@@ -0,0 +1,113 @@
+""" Builds zip archives chunk by chunk so that they can be streamed to the client """
+from django.http import StreamingHttpResponse
+from uuid import uuid4
+import zipfile
+import io
+import os
+
+
+# Codec used for archive entries (audio is already compressed so it is stored as is by default)
+ARCHIVE_COMPRESSION = zipfile.ZIP_STORED
+
+# Size (bytes) of the chunks read from the archived files
+CHUNK_SIZE = 1024 * 1024
+
+
+class ZipStream(io.RawIOBase):
+    """
+    Write-only, unseekable file object that holds the zip bytes written since the last pop()
+    """
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def pop(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_zip(files, compression=None):
+    """
+    Yields a zip archive of files(param) chunk by chunk (memory use does not depend on archive size)
+    ...
+    Parameters :
+    - files       : iterable of (file_path, name_inside_archive) tuples
+    - compression : zipfile compression codec (ARCHIVE_COMPRESSION by default)
+    """
+    if compression is None:
+        compression = ARCHIVE_COMPRESSION
+    stream = ZipStream()
+
+    with zipfile.ZipFile(stream, 'w', compression, allowZip64=True) as zip_file:
+        for file_path, arcname in files:
+            info = zipfile.ZipInfo.from_file(file_path, arcname)
+            info.compress_type = compression
+            with open(file_path, 'rb') as src, zip_file.open(info, 'w', force_zip64=True) as dest:
+                while True:
+                    chunk = src.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    dest.write(chunk)
+                    yield stream.pop()
+            yield stream.pop()
+
+    # Central directory
+    yield stream.pop()
+
+
+def dir_files(dir_path):
+    """
+    Returns (file_path, name_inside_archive) tuples for every file inside dir_path(param)
+    """
+    files = []
+    for root, dirs, filenames in os.walk(dir_path):
+        for file in filenames:
+            file_path = os.path.join(root, file)
+            files.append((file_path, os.path.relpath(file_path, dir_path)))
+
+    return files
+
+
+def zip_response(files, zip_filename):
+    """
+    Returns a StreamingHttpResponse that sends files(param - see stream_zip) as zip_filename(param)
+    """
+    response = StreamingHttpResponse(stream_zip(files), content_type='application/zip')
+    response['Content-Disposition'] = f'attachment; filename="{zip_filename}"'
+
+    return response
+
+
+def archive_path(dir_path):
+    """
+    Returns the path of the archive built for a job directory (next to it - <dir_path>.zip)
+    """
+    return os.path.normpath(dir_path) + '.zip'
+
+
+def build_archive(dir_path):
+    """
+    Writes the zip archive of dir_path(param) to the disk (once - so it can be served with ranges/resumed)
+    and returns its path.
+    """
+    zip_path = archive_path(dir_path)
+    if not os.path.exists(zip_path):
+        tmp_path = f'{zip_path}.{uuid4().hex[:8]}.part'
+        try:
+            with open(tmp_path, 'wb') as f:
+                for chunk in stream_zip(dir_files(dir_path)):
+                    f.write(chunk)
+            os.replace(tmp_path, zip_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    return zip_path
@@ -0,0 +1,102 @@
+""" Post-download audio stage - remuxes/transcodes stored tracks using ffmpeg (a few processes at a time) """
+from threading import BoundedSemaphore
+from shutil import which
+from uuid import uuid4
+import subprocess
+import os
+
+from .models import TrackLog
+
+
+# Formats a track can be converted to (besides 'original' - the container youtube sent)
+# remux_from : source containers whose audio can be copied as is into the format
+AUDIO_FORMATS = {
+    'mp3': {'remux_from': (), 'args': ['-c:a', 'libmp3lame', '-q:a', '2']},
+    'm4a': {'remux_from': ('m4a',), 'args': ['-c:a', 'aac', '-b:a', '192k']},
+    'opus': {'remux_from': ('webm',), 'args': ['-c:a', 'libopus', '-b:a', '160k']},
+}
+
+# Number of ffmpeg processes run at the same time (per process)
+CONVERT_WORKERS = os.cpu_count() or 1
+
+# Path of the ffmpeg executable (None if it isn't installed - only 'original' can be sent then)
+FFMPEG = which('ffmpeg')
+
+# ffmpeg is a process of its own - the calling thread just waits for it (blocking only itself)
+convert_slots = BoundedSemaphore(CONVERT_WORKERS)
+
+
+def audio_ext(file_path):
+    """
+    Returns the extension (container) of an audio file without the dot (example : m4a)
+    """
+    return os.path.splitext(file_path)[1][1:]
+
+
+def converted_size(src_path):
+    """
+    Returns the number of bytes taken by the converted versions of a stored track(src_path:param)
+    """
+    total = 0
+    for ext in AUDIO_FORMATS:
+        file_path = f'{os.path.splitext(src_path)[0]}.{ext}'
+        if file_path == src_path:
+            continue
+        try:
+            total += os.path.getsize(file_path)
+        except FileNotFoundError:
+            pass
+
+    return total
+
+
+def run_ffmpeg(src_path, dest_path, args):
+    """
+    Converts src_path into dest_path using ffmpeg (at most CONVERT_WORKERS at a time)
+    """
+    tmp_path = f'{os.path.splitext(dest_path)[0]}.{uuid4().hex[:8]}.{audio_ext(dest_path)}'
+    try:
+        with convert_slots:
+            subprocess.run(
+                [FFMPEG, '-y', '-loglevel', 'error', '-i', src_path, '-vn', *args, tmp_path],
+                check=True, stdin=subprocess.DEVNULL
+            )
+        os.replace(tmp_path, dest_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def convert_track(track, audio_format='original'):
+    """
+    Returns the path of a stored track(TrackLog param) in audio_format(param).
+    Conversions are cached next to the stored track (keyed by the track's youtube video id)
+    and only transcode when the audio can't simply be remuxed.
+    Raises RuntimeError if ffmpeg isn't installed (the track is never sent in another format than asked).
+    ...
+    Parameters :
+    - track        : TrackLog of the stored track
+    - audio_format : 'original' or one of AUDIO_FORMATS
+    """
+    src_path = track.file_path
+    src_ext = audio_ext(src_path)
+    if audio_format not in AUDIO_FORMATS or audio_format == src_ext:
+        return src_path
+
+    dest_path = f'{os.path.splitext(src_path)[0]}.{audio_format}'
+    if os.path.exists(dest_path):
+        return dest_path
+
+    if FFMPEG is None:
+        raise RuntimeError(f'ffmpeg not found - unable to convert {track} to {audio_format}')
+
+    if src_ext in AUDIO_FORMATS[audio_format]['remux_from']:
+        args = ['-c:a', 'copy']
+    else:
+        args = AUDIO_FORMATS[audio_format]['args']
+    run_ffmpeg(src_path, dest_path, args)
+
+    # Counted in the disk budget (see storage.used_space)
+    TrackLog.object.filter(pk=track.pk).update(converted_size=converted_size(src_path))
+
+    return dest_path
@@ -0,0 +1,9 @@
+""" Template context shared by every page """
+from .audio import AUDIO_FORMATS, FFMPEG
+
+
+def audio_formats(request):
+    """
+    Adds the audio formats the download forms offer besides 'original' (none without ffmpeg)
+    """
+    return {'audio_formats': list(AUDIO_FORMATS) if FFMPEG else []}
@@ -1,92 +1,96 @@
 """ Contains helper functions that download multiple files """
-from django.shortcuts import HttpResponse
-from django_celery_results.models import  TaskResult
-
-import io
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from django.db import connection
 from uuid import uuid4
-import zipfile
-from pytubefix import YouTube
 from datetime import datetime
-from time import sleep
+from math import ceil
+from time import monotonic
+import os
 
-from .helpers import get_youtube_url
+from .track_store import fetch_track
+from .archive import zip_response
+from .audio import convert_track, audio_ext
+from .helpers import fix_filename
 
 
+# Number of tracks fetched at the same time by download_20
+FETCH_WORKERS = 8
 
-def download_20(request, songs_len):
-    """Downloads 20 tracks into the zipbuffer and then to client's PC"""
-    # Initializing zip buffer
-    zip_buffer = io.BytesIO()
-    zip_filename = f'{uuid4().hex[:8]}_{datetime.now().strftime("%Y%m%d%H%M%S")}.zip'
-    unavailable = []
+# Time (seconds) a single track is allowed to take (search + download + conversion)
+TRACK_TIMEOUT = 120
 
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for i in range(1, songs_len + 1):
-            search_string = request.POST.get(f'song_name_{i}')
-            yt_url = get_youtube_url(search_string)
-            yt = YouTube(yt_url)
-            audio_stream = yt.streams.get_audio_only()
-
-            if audio_stream:
-                # Download audio stream into memory without creating any temp file
-                audio_buffer = io.BytesIO()
-                audio_stream.stream_to_buffer(audio_buffer)
-                audio_buffer.seek(0)
-
-                # Add the audio stream into zip archive
-                filename = f'{search_string}.mp3'
-                zipf.writestr(filename, audio_buffer.read())
-            else:
-                unavailable.append(search_string)
-                continue
-
-    zip_buffer.seek(0) # resets the seek to 0
-    response = HttpResponse(zip_buffer, content_type='application/zip')
-    response['Content-Disposition'] = f'attachment; filename="{zip_filename}"'
 
-    print(f'Unavailable tracks : {unavailable}')
+def fetch_track_worker(audio_format, search_string, track_id, duration=None):
+    """
+    fetch_track() and convert_track() run inside a pool thread (closes the thread's db connection when done)
+    Returns the path of the track in audio_format(param) or None if it could not be downloaded.
+    """
+    try:
+        track = fetch_track(search_string, spotify_id=track_id, duration=duration)
+        return convert_track(track, audio_format) if track else None
+    finally:
+        connection.close()
+
+
+def fetch_tracks(song_inputs, audio_format='original', workers=FETCH_WORKERS, timeout=TRACK_TIMEOUT):
+    """
+    Fetches (and converts) the given songs concurrently (at most workers(param) at a time) and returns
+    the paths of their files in the same order as song_inputs (None for songs that failed or timed out).
+    ...
+    Parameters :
+    - song_inputs  : list of [song_name, spotify_track_id, duration] lists
+    - audio_format : 'original' or one of audio.AUDIO_FORMATS
+    - workers      : maximum number of tracks fetched at the same time
+    - timeout      : time (seconds) a single track is allowed to take (download and conversion)
+    """
+    if not song_inputs:
+        return []
 
-    return response
+    executor = ThreadPoolExecutor(max_workers=min(workers, len(song_inputs)))
+    futures = [executor.submit(fetch_track_worker, audio_format, *song_input) for song_input in song_inputs]
 
-def timeout_mech(songs_fragments, r_batch_id):
+    # Every track gets its timeout - tracks queued behind others get their share of waiting too
+    deadline = monotonic() + timeout * ceil(len(song_inputs) / workers)
+    tracks = []
+    for (song, *_), future in zip(song_inputs, futures):
+        try:
+            tracks.append(future.result(timeout=max(0, deadline - monotonic())))
+        except TimeoutError:
+            print(f'Timed out downloading {song}')
+            tracks.append(None)
+        except Exception as e:
+            print(f'Unable to download {song} : {e}')
+            tracks.append(None)
+
+    # Don't wait for the timed out tracks
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    return tracks
+
+
+def download_20(song_inputs, audio_format='original'):
     """
-    timeout mechanism to check if all the celery workers have logged their jobs
-    into django-celer-tasks db table
+    Downloads 20 tracks (concurrently) and streams them as a zip archive to client's PC
+    (tracks already in the track store are not downloaded again)
+    ...
+    Parameter :
+    - song_inputs  : list of [song_name, spotify_track_id, duration] lists (got from helpers.get_song_inputs)
+    - audio_format : 'original' or one of audio.AUDIO_FORMATS
     """
-    # Wait until all tasks are complete
-    batch_length = len(songs_fragments)
-    print('Batch length : ', batch_length)
-    prev, curr = 0, 0
-    initial_tasks_length = 0
-    repeater = 0
-    sleep_time = 15
-    while True:
-        tasks = TaskResult.objects.all().filter(result=f'"{r_batch_id}"')
-
-        sleep(sleep_time)
-
-        tasks_len = len(tasks)
-        print('Sleep time', sleep_time)
-        print('tasks length : ', tasks_len)
-        print('prev : ', prev, 'curr', curr)
-        print('------------------------')
-        if tasks_len > initial_tasks_length:
-            sleep_time = 6
-            # Now the task length has started going up
-            curr = tasks_len
-            print('printing prev and curr inside if', prev, curr)
-            if prev == curr:
-                if repeater == 15:
-                    print('broken from repeated tasks')
-                    break
-                repeater += 1
-            elif prev != curr and repeater > 1:
-                repeater = 1
-
-            prev, curr = curr, 0
-
-        if tasks_len == batch_length:
-            print('broken after matching batch_length')
-            break
-
-    print(f'Tasks {tasks} with length {len(tasks)}')
+    zip_filename = f'{uuid4().hex[:8]}_{datetime.now().strftime("%Y%m%d%H%M%S")}.zip'
+    files = []
+    unavailable = []
+
+    # Tracks are converted as soon as they are downloaded (several at a time)
+    for (search_string, *_), file_path in zip(song_inputs, fetch_tracks(song_inputs, audio_format)):
+        if file_path:
+            # Add the audio track into zip archive
+            # (song names may contain path separators - example : AC/DC)
+            file_name = fix_filename(search_string) or os.path.splitext(os.path.basename(file_path))[0]
+            files.append((file_path, f'{file_name}.{audio_ext(file_path)}'))
+        else:
+            unavailable.append(search_string)
+
+    print(f'Unavailable tracks : {unavailable}')
+
+    return zip_response(files, zip_filename)
@@ -1,18 +1,33 @@
 import uuid
-from .models import VideoLog, KeyLog
-from pathlib import Path
+import asyncio
+from .models import VideoLog, TrackLog, DownloadJob, DownloadItem, parse_file_metadata
 from datetime import datetime, timedelta
-from .spotify import get_token
-from pytubefix import Search, YouTube
-from .tasks import download_batch
-from celery import group
-import time
+from .spotify_token import token_holder
+from . import spotify_async
+from django.core.cache import caches
+from django.db import connection
+from asgiref.sync import sync_to_async
+from pytubefix import YouTube
+from .tasks import resolve_item, download_track, resolve_tracks, finish_when_done
+from .track_store import fetch_track, link_track
+from . import track_store
+from .audio import AUDIO_FORMATS, FFMPEG, convert_track, audio_ext
+from .rate_limit import acquire
+from . import storage
+from urllib.parse import urlparse
+from celery import chain
 import os
 
 
 # File (audio/directory) expiring duration in minutes
 EXPIRES_IN = 30
 
+# Version of the cached playlist/album data (bumped whenever the song tuples change shape)
+SPOTIFY_CACHE_VERSION = 2
+
+# Time (seconds) a background resolution may wait in the queue / run for (see start_resolution)
+RESOLVE_EXPIRES_IN = 10 * 60
+
 
 def fix_filename(filename):
     """
@@ -46,33 +61,68 @@ def calculate_duration(length) -> str:
     return duration
 
 
-def check_db(filename, f_type='YT', spotify_id=None) -> bool:
+def get_audio_format(request):
+    """
+    Returns the audio format picked in the download form
+    ('original' if missing, not supported or ffmpeg isn't installed - see context_processors.audio_formats)
+    """
+    audio_format = request.POST.get('audio_format', 'original')
+    return audio_format if audio_format in AUDIO_FORMATS and FFMPEG else 'original'
+
+
+def format_file_id(f_id, audio_format='original'):
+    """
+    Adds the audio format to a file_id so that every format of a file is logged separately
+    (example : sp_album__123532, mp3 -> sp_album_mp3__123532 ; yt_audio, opus -> yt_audio_opus)
+    """
+    if audio_format == 'original':
+        return f_id
+
+    prefix, sep, external_id = f_id.partition('__')
+    return f'{prefix}_{audio_format}{sep}{external_id}'
+
+
+def load_youtube(link):
+    """
+    Returns (yt, duration) of a youtube link - fetches the video's info up front (blocking)
+    so that rendering the page doesn't
+    """
+    yt = YouTube(link, 'WEB')
+    acquire('stream')
+    duration = calculate_duration(yt.length)
+    # Loaded here - the template reads them
+    yt.title, yt.thumbnail_url
+
+    return yt, duration
+
+
+def find_log(f_id, filename=None):
     """
-    Returns True if filename(pram) or
-    spotify_id does not present in database
+    Returns the VideoLog of an already downloaded file (or None) using the indexed
+    (source, kind, external_id) columns.
     ...
     Parameters :
-    - filename   : File name that should be checked in the db(VideoLog)
-    - f_type     : File type - 'YT' for youtube audio(default) - 'SP' for spotify
-    - spotify_id : id of a spotify playlist/album/track)
-    """
-    # Checking database if the current file already exists
-    update_db = True
-    if f_type == 'SP':
-        all_logs = VideoLog.object.filter(file_metadata__startswith='sp_')
-    else:
-        all_logs = VideoLog.object.filter(file_metadata__startswith='yt_')
+    - f_id     : file_id(str) of the file (example : yt_audio or sp_album__123532)
+    - filename : File name (without extension) of the youtube audio (used only when f_id is yt_audio)
+    """
+    source, kind, external_id = parse_file_metadata(f_id)
+    if source == 'yt':
+        external_id = filename
+
+    return VideoLog.object.filter(source=source, kind=kind, external_id=external_id).first()
 
-    for file in all_logs:
-        if filename and file.file_name == filename:
-            update_db = False
-        if spotify_id and file.file_metadata.split('__')[-1] == spotify_id:
-            update_db = False
 
-    return update_db
+def extend_expiry(log):
+    """
+    Pushes the expiring time of a reused file/directory(log:param - VideoLog) EXPIRES_IN minutes ahead
+    (sliding expiry - popular files stay on the server)
+    """
+    VideoLog.object.filter(pk=log.pk, expires_at__isnull=False).update(
+        expires_at=datetime.now().replace(tzinfo=None) + timedelta(minutes=EXPIRES_IN)
+    )
 
 
-def download_song(song_name, yt, f_id):
+def download_song(song_name, yt, f_id, audio_format='original', duration=None):
     """
     Downloads the given song(song_name:param) to the server and stores its info to db(VideoLog)
     OR returns exiting info if file already exists.
@@ -80,31 +130,31 @@ def download_song(song_name, yt, f_id):
     Parameters :
     - song_name : Name of the song to download (without extension)
     - yt        : pytubefix.Youtube() class's object of the given song
+                  (None - searched on youtube using song_name, only if the track isn't already stored)
     - f_id     : file_id(str) containing metadata about the function call
                 (example : yt_audio or sp_album__123532 - sp : denotes spotify,
                                              album : denotes that this function is called to download spotify album,
                                              123532 : spotify album id)
+    - audio_format : 'original' or one of audio.AUDIO_FORMATS
+    - duration     : length of the song in seconds (helps picking the right youtube search result)
     returns :
-    - song_to_download  : song name with extension - .mp3
-    -  filepath         : file path of that song
+    - VideoLog of the downloaded song (None if it could not be downloaded)
     """
-    CWD_PATH = Path(__file__).resolve().parent.parent
-    base_dir = os.path.join(CWD_PATH, '..\\files')
-    os.makedirs(base_dir, exist_ok=True)
+    # Read at call time (see track_store.FILES_DIR)
+    filepath = track_store.FILES_DIR
+    os.makedirs(filepath, exist_ok=True)
 
-    filepath = base_dir
-    song_to_download = song_name + '.mp3' # or'.m4a' '.aac'
+    spotify_id = f_id.split('__')[-1] if f_id.startswith('sp_') else None
+    f_id = format_file_id(f_id, audio_format)
 
-    if f_id.startswith('yt_'):
-        do_update = check_db(song_to_download)
-    else:
-        do_update = check_db('', f_type='SP', spotify_id=f_id.split('__')[-1])
+    existing_file = find_log(f_id, filename=song_name)
 
-    if do_update:
+    if existing_file is None:
         # saving song's data to db if it does not already exist
-        ys = yt.streams.get_audio_only()
-        if ys:
-            ys.download(output_path=filepath, filename=song_to_download)
+        track = fetch_track(song_name, spotify_id=spotify_id, yt=yt, duration=duration)
+        if track:
+            converted_path = convert_track(track, audio_format)
+            song_to_download = f'{song_name}.{audio_ext(converted_path)}'
             file_info = VideoLog(
                 file_path=filepath,
                 file_name=song_to_download,
@@ -112,80 +162,158 @@ def download_song(song_name, yt, f_id):
                 expires_at=datetime.now().replace(tzinfo=None) + timedelta(minutes=EXPIRES_IN)
             )
             file_info.save()
+            link_track(track, os.path.join(filepath, song_to_download), file_info, file_path=converted_path)
+            return file_info
         else:
             print(f'Unable to download song')
-
-        return song_to_download, filepath
+            return None
 
     else:
-        # If the file already exists - just return the filename and filepath
-        if f_id == 'yt_audio':
-            # If existing song is downloaded from yt, the search using song name
-            existing_file = VideoLog.object.get(file_name=song_to_download)
-        else:
-            # else if it's from spotify > get using its id
-            existing_file = VideoLog.object.get(file_metadata__endswith=f_id.split('__')[-1])
+        # If the file already exists - just return its log
+        extend_expiry(existing_file)
+        return existing_file
+
 
-        return existing_file.file_name, existing_file.file_path
+def get_spotify_token():
+    """
+    Returns the Spotify API token held by this process
+    (refreshed in the background before it expires - see spotify_token.TokenHolder)
+    """
+    return token_holder.get()
 
 
-def get_youtube_url(search_query):
+async def aget_spotify_token():
     """
-    Returns the first result's watch URL from youtube when searched using
-    search_query(param) using pytube.Search()
+    Async version of get_spotify_token (a held token is returned without leaving the event loop)
     """
-    searches = Search(search_query + 'official audio')
-    return searches.videos[0].watch_url
+    if token_holder.is_fresh():
+        return token_holder.token
+    return await run_blocking(token_holder.get)
 
 
-def get_spotify_token(add_new=False):
+async def aget_playlist_data(token, playlist_id):
     """
-    Checks KeyLog table if api_key already exists - if it does then return existing key,
-    else return a new(got from Spotify API) one.
-    ...
-    Parameter :
-    - add_new : used only when called by scheduler
-    """
-    existing_token = KeyLog.object.first()
-    if not existing_token or add_new:
-        token = get_token()
-        time.sleep(3)
-        new_token = KeyLog(
-            api_token=token,
-            expires_at=datetime.now().replace(tzinfo=None) + timedelta(seconds=3600)
+    Returns (playlist_songs, playlist_info) of a spotify playlist (see spotify_async.get_playlist_tracks / get_playlist_info)
+    from the metadata cache - the cache key contains the playlist's snapshot_id so an edited playlist is fetched again.
+    """
+    snapshot_id = await spotify_async.get_playlist_snapshot(token, playlist_id)
+    key = f'playlist:{playlist_id}:{snapshot_id}'
+    cache = caches['spotify']
+
+    data = await cache.aget(key, version=SPOTIFY_CACHE_VERSION) if snapshot_id else None
+    if data is None:
+        data = await asyncio.gather(
+            spotify_async.get_playlist_tracks(token, playlist_id),
+            spotify_async.get_playlist_info(token, playlist_id)
         )
-        new_token.save()
-        result = token
-    else:
-        result = existing_token.api_token
+        data = tuple(data)
+        if snapshot_id and data[0]:
+            await cache.aset(key, data, version=SPOTIFY_CACHE_VERSION)
+
+    return data
+
+
+async def aget_album_data(token, album_id):
+    """
+    Returns (album_songs, album_info) of a spotify album (see spotify_async.get_album_tracks / get_album_info)
+    from the metadata cache.
+    """
+    key = f'album:{album_id}'
+    cache = caches['spotify']
+
+    data = await cache.aget(key, version=SPOTIFY_CACHE_VERSION)
+    if data is None:
+        data = await asyncio.gather(
+            spotify_async.get_album_tracks(token, album_id),
+            spotify_async.get_album_info(token, album_id)
+        )
+        data = tuple(data)
+        if data[0]:
+            await cache.aset(key, data, version=SPOTIFY_CACHE_VERSION)
+
+    return data
 
-    if not add_new:
-        return result
+
+def close_connection_after(func):
+    """
+    Wraps func(param) so that the db connection of the thread running it is closed when it returns
+    (worker threads of run_blocking never see a request_finished signal)
+    """
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            connection.close()
+
+    return wrapper
+
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Runs a blocking function (pytubefix, downloads, db queries) in a worker thread
+    so that the event loop keeps serving other requests while it waits.
+    """
+    return await sync_to_async(close_connection_after(func), thread_sensitive=False)(*args, **kwargs)
 
 
-def create_song_batches(song_list, batch_size=10):
+def get_song_inputs(request, songs):
     """
-    Breaks the entire song_list(spotify playlist/album) into fragments(param:fragment_size) and
-    returns them in a list
+    Returns a list of [song_name, spotify_track_id, duration(seconds)] for every song submitted
+    with the playlist/album download form.
     ...
     Parameters :
-    - song_list  : long list of songs (over 20 at least)
-    - batch_size : Size of each song batch (10 by default)
+    - request : POST request of the playlist/album page
+    - songs   : list of tuples got from spotify_async.get_playlist_tracks / get_album_tracks
     """
-    lst_chunks = []
-    n = len(song_list)
-    rem = n % batch_size
+    song_inputs = []
+    for i, _, _, track_api_link, duration_ms in songs:
+        song = request.POST.get(f'song_name_{i}')
+        if song:
+            track_id = urlparse(track_api_link).path.split('/')[-1]
+            song_inputs.append([song, track_id, round(duration_ms / 1000) if duration_ms else None])
 
-    for i in range(0, n - batch_size + 1, batch_size):
-        start = i
-        end = start + batch_size
-        lst_chunks.append(song_list[start:end])
+    return song_inputs
 
-    if rem > 0:
-        print('inhere')
-        lst_chunks.append(song_list[n - rem: n + 1: 1])
 
-    return lst_chunks
+def start_resolution(f_id, songs):
+    """
+    Queues the background (low priority) youtube search of a listed playlist/album's songs
+    so that a download started later finds them resolved. Songs already in the track store are skipped
+    and a playlist/album is resolved only once at a time.
+    ...
+    Parameters :
+    - f_id  : file_id(str) of the playlist/album (example : sp_album__123532)
+    - songs : list of tuples got from spotify_async.get_playlist_tracks / get_album_tracks
+    """
+    resolve_key = f'resolve:{f_id}'
+    if not caches['spotify'].add(resolve_key, True, timeout=RESOLVE_EXPIRES_IN):
+        # Already queued or running
+        return
+
+    track_ids = {urlparse(song[3]).path.split('/')[-1]: song for song in songs}
+    stored = set(TrackLog.object.filter(spotify_id__in=track_ids).values_list('spotify_id', flat=True))
+    queries = [
+        [f'{name} - {artists}', round(duration_ms / 1000) if duration_ms else None]
+        for track_id, (_, name, artists, _, duration_ms) in track_ids.items() if track_id not in stored
+    ]
+    if not queries:
+        caches['spotify'].delete(resolve_key)
+        return
+
+    try:
+        resolve_tracks.apply_async((resolve_key, queries), priority=0, expires=RESOLVE_EXPIRES_IN)
+    except Exception as e:
+        # The page works without it - the download resolves the songs itself
+        caches['spotify'].delete(resolve_key)
+        print(f'Unable to queue resolution of {f_id} : {e}')
+
+
+def cancel_resolution(f_id):
+    """
+    Stops the background resolution of a playlist/album (see start_resolution) - the download takes over
+    (songs resolved so far are reused from the search cache).
+    """
+    caches['spotify'].delete(f'resolve:{f_id}')
 
 
 def get_filename(path):
@@ -197,71 +325,90 @@ def get_filename(path):
     return file_name
 
 
-def download_song_fragment(dir_path, song_fgs, f_id):
+def download_song_fragment(dir_path, song_inputs, f_id, audio_format='original'):
     """
-    Downloads song(song_fgs:param) into a unique directory(param) in the server.
+    Downloads songs(song_inputs:param) into a unique directory(param) in the server.
     ...
     Parameters :
-    - dir_path : The absolute directory path with the unique directory
-    - song_fgs : list of list containing songs in fragments(groups for concurrent download)
+    - dir_path    : The absolute directory path with the unique directory
+    - song_inputs : list of [song_name, spotify_track_id, duration] (each one is downloaded by its own celery task)
     - f_id     : file_id(str) containing metadata about the function call
                 (example : sp_album_123532 - sp : denotes spotify,
                                              album : denotes that this function is called to download spotify album,
                                              123532 : spotify album id)
+    - audio_format : 'original' or one of audio.AUDIO_FORMATS
     ...
     Returns :
+    - job_id   : id of the job (DownloadJob) - used to check its progress
     - dir_path : absolute directory path with the unique directory name
     - filename : unique directory's name
     """
-    if check_db('', f_type='SP', spotify_id=f_id.split('__')[-1]):
+    f_id = format_file_id(f_id, audio_format)
+    existing_dir = find_log(f_id)
+
+    if existing_dir is not None and DownloadJob.object.filter(log=existing_dir, status='failed').exists():
+        # A failed job is started again instead of being handed out
+        storage.delete_logs([existing_dir])
+        existing_dir = None
+
+    if existing_dir is None:
         os.mkdir(dir_path)
 
         file_name = get_filename(dir_path)
 
-        b_id = uuid.uuid4().hex[:15]
         file_info = VideoLog(
             file_path=dir_path,
             file_type='directory',
             file_metadata=f_id,
-            expires_at=datetime.now().replace(tzinfo=None) + timedelta(minutes=EXPIRES_IN),
-            batch_id=b_id
+            expires_at=datetime.now().replace(tzinfo=None) + timedelta(minutes=EXPIRES_IN)
         )
         file_info.save()
 
-        task_list = []
-        for frag in song_fgs:
-            # Perform this task using django-celery
-            task_list.append(download_batch.s(frag, b_id, dir_path))
+        job = DownloadJob.object.create(job_id=uuid.uuid4().hex[:15], log=file_info, total=len(song_inputs),
+                                        updated_at=datetime.now().replace(tzinfo=None))
+        DownloadItem.object.bulk_create([
+            DownloadItem(job=job, position=position, song_name=song, spotify_id=track_id, duration=duration)
+            for position, (song, track_id, duration) in enumerate(song_inputs, start=1)
+        ])
+        item_ids = job.items.order_by('position').values_list('pk', flat=True)
+
+        # Perform this task using django-celery (one resolve -> download chain per song)
+        # - the song that completes the job queues tasks.finish_download
+        for item_id in item_ids:
+            chain(resolve_item.s(item_id), download_track.s(audio_format)).apply_async()
 
-        jobs = group(task_list)
-        jobs.apply_async()
+        # Nothing to download (no songs picked)
+        finish_when_done(job.pk)
 
-        return b_id, dir_path, file_name
+        return job.job_id, dir_path, file_name
 
     else:
-        existing_dir = VideoLog.object.get(file_metadata__endswith=f_id.split('__')[-1])
+        extend_expiry(existing_dir)
         file_path = existing_dir.file_path
         file_name = get_filename(file_path)
+        job_id = DownloadJob.object.filter(log=existing_dir).values_list('job_id', flat=True).first()
 
-        return None, file_path, file_name
+        return job_id, file_path, file_name
 
 
-def write_unavailable_songs(songs_list, downloaded_contents, dir_path):
+def get_job_status(job_id):
     """
-    Writes the list of un-downloaded songs(un-downloaded due to some error while using celery django)
-    to a readme.txt file inside unique dir.
+    Returns the progress of a playlist/album job as a dictionary (None if the job does not exist)
+    Example : {'status': 'pending', 'done': 12, 'failed': 1, 'total': 40}
+    (status : 'pending', 'finishing', 'ready' or 'failed')
     """
-    d_contents = set()
-    for s in downloaded_contents:
-        file_rep = s.replace('.mp3', '')
-        file_fix = fix_filename(file_rep)
-        d_contents.add(file_fix)
+    job = DownloadJob.object.filter(job_id=job_id).values('status', 'done_count', 'failed_count', 'total').first()
+    if job is None:
+        return None
+
+    return {'status': job['status'], 'done': job['done_count'], 'failed': job['failed_count'], 'total': job['total']}
 
-    remaining_songs = []
-    for song in songs_list:
-        if fix_filename(song) not in d_contents:
-            remaining_songs.append(song)
 
+def write_unavailable_songs(remaining_songs, dir_path):
+    """
+    Writes the list of un-downloaded songs(remaining_songs:param - see tasks.finish_download)
+    to a readme.txt file inside unique dir.
+    """
     if remaining_songs:
         # Cannot download remaining songs so write it to a txt file
         with open(os.path.join(dir_path, '000_readme.txt'), 'w') as f:
@@ -0,0 +1,492 @@
+""" Offline end-to-end benchmark - stub Spotify/stream servers and a fake pytubefix (python manage.py benchmark) """
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.db import connection
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from requests import Session
+from requests.adapters import HTTPAdapter
+from threading import Thread
+from time import sleep, perf_counter
+import tempfile
+import asyncio
+import resource
+import hashlib
+import random
+import shutil
+import json
+import sys
+import os
+
+
+# Size (bytes) of the chunks the stub stream server sends (bandwidth is applied per chunk)
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class BenchConfig:
+    """
+    Latency (seconds), bandwidth (bytes/second) and failure rates (0 - 1) of the stand-in services
+    """
+    def __init__(self, options):
+        self.spotify_latency = options['spotify_latency'] / 1000
+        self.search_latency = options['search_latency'] / 1000
+        self.info_latency = options['info_latency'] / 1000
+        self.bandwidth = options['bandwidth'] * 1024
+        self.track_size = options['track_size'] * 1024
+        self.search_failure_rate = options['search_failure_rate']
+        self.stream_failure_rate = options['stream_failure_rate']
+        self.random = random.Random(options['seed'])
+
+    def fails(self, rate):
+        return self.random.random() < rate
+
+
+def video_id(query):
+    """
+    Returns the (11 character) fake youtube video id of a search query
+    """
+    return hashlib.sha1(query.encode('utf-8')).hexdigest()[:11]
+
+
+def track_duration(index):
+    """
+    Returns the duration (ms) of the index(param)-th stub track
+    """
+    return 150000 + (index % 90) * 1000
+
+
+def stub_track(playlist_id, index):
+    """
+    Returns the Spotify API json of the index(param)-th track of a stub playlist
+    """
+    track_id = f'{playlist_id}t{index}'
+    return {
+        'name': f'Song {playlist_id} {index}',
+        'id': track_id,
+        'href': f'https://api.spotify.com/v1/tracks/{track_id}',
+        'duration_ms': track_duration(index),
+        'artists': [{'name': f'Artist {index % 50}'}],
+    }
+
+
+def make_handler(config):
+    """
+    Returns the request handler of the stub server - Spotify endpoints used by spotify_async.py, the token
+    endpoint (spotify.get_token) and audio streams
+    Playlist ids carry their size (example : p3x250 - playlist 3 with 250 tracks)
+    """
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, data, status=200):
+            body = json.dumps(data).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            # accounts.spotify.com/api/token
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self.send_json({'access_token': 'bench', 'expires_in': 3600})
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            query = parse_qs(url.query)
+            parts = url.path.strip('/').split('/')
+
+            if parts[0] == 'stream':
+                return self.send_stream(parts[1], query)
+
+            sleep(config.spotify_latency)
+            if parts[:2] == ['v1', 'playlists']:
+                playlist_id = parts[2]
+                total = int(playlist_id.split('x')[-1])
+                if len(parts) == 4:
+                    offset = int(query.get('offset', ['0'])[0])
+                    limit = int(query.get('limit', ['100'])[0])
+                    items = [{'track': stub_track(playlist_id, i)} for i in range(offset, min(offset + limit, total))]
+                    return self.send_json({'total': total, 'items': items})
+                if query.get('fields') == ['snapshot_id']:
+                    return self.send_json({'snapshot_id': f'snap-{playlist_id}'})
+                return self.send_json({
+                    'name': f'Playlist {playlist_id}',
+                    'images': [{'url': 'http://localhost/cover.jpg'}],
+                    'owner': {'display_name': 'bench', 'external_urls': {'spotify': 'http://localhost/user'}},
+                })
+
+            if parts[:2] == ['v1', 'tracks'] and len(parts) == 3:
+                playlist_id, _, index = parts[2].rpartition('t')
+                track = stub_track(playlist_id, int(index))
+                track.update({
+                    'album': {'images': [{'url': 'http://localhost/cover.jpg'}]},
+                    'external_urls': {'spotify': f'https://open.spotify.com/track/{track["id"]}'},
+                })
+                return self.send_json(track)
+
+            self.send_json({'error': 'not found'}, status=404)
+
+        def send_stream(self, youtube_id, query):
+            size = int(query['size'][0])
+            start, end = 0, size - 1
+            if 'range' in query:
+                start, end = [int(n) for n in query['range'][0].split('-')]
+                end = min(end, size - 1)
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'audio/mp4')
+            self.send_header('Content-Length', str(end - start + 1))
+            self.end_headers()
+
+            # Deterministic content - the same video always has the same bytes
+            pattern = (youtube_id.encode('utf-8') * (STREAM_CHUNK_SIZE // len(youtube_id) + 1))[:STREAM_CHUNK_SIZE]
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = pattern[:min(STREAM_CHUNK_SIZE, remaining)]
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+                if config.bandwidth:
+                    sleep(len(chunk) / config.bandwidth)
+
+    return StubHandler
+
+
+class StubAdapter(HTTPAdapter):
+    """
+    Sends the requests meant for Spotify to the stub server instead
+    """
+    def __init__(self, base_url):
+        super().__init__()
+        self.base_url = base_url
+
+    def send(self, request, **kwargs):
+        url = urlsplit(request.url)
+        request.url = self.base_url + url.path + (f'?{url.query}' if url.query else '')
+        return super().send(request, **kwargs)
+
+
+class FakeVideo:
+    """
+    Search result video (only the id is read from it - see resolver.get_candidates)
+    """
+    def __init__(self, youtube_id):
+        self.video_id = youtube_id
+
+
+def make_fake_search(config, durations):
+    """
+    Returns a stand-in for pytubefix.Search - results come with a live version and a loop
+    ahead of the right video so that the matcher does its job.
+    durations(param) : search query -> track duration (seconds)
+    """
+    def renderer(youtube_id, title, channel, length):
+        return {'videoRenderer': {
+            'videoId': youtube_id,
+            'title': {'runs': [{'text': title}]},
+            'ownerText': {'runs': [{'text': channel}]},
+            'lengthText': {'simpleText': f'{length // 60}:{length % 60:02d}'},
+        }}
+
+    class FakeSearch:
+        def __init__(self, query):
+            sleep(config.search_latency)
+            if config.fails(config.search_failure_rate):
+                raise ConnectionError(f'Search failed for {query}')
+
+            name, _, artists = query.partition(' - ')
+            duration = durations.get(query, 200)
+            items = [
+                renderer(video_id(query + ' live'), f'{name} (Live)', artists, duration + 75),
+                renderer(video_id(query + ' loop'), f'{name} 1 hour loop', 'Loops', 3600),
+                renderer(video_id(query), name, f'{artists} - Topic', duration),
+            ]
+            self._initial_results = {'contents': {'twoColumnSearchResultsRenderer': {'primaryContents': {
+                'sectionListRenderer': {'contents': [{'itemSectionRenderer': {'contents': items}}]}
+            }}}}
+            self.videos = [FakeVideo(item['videoRenderer']['videoId']) for item in items]
+
+    return FakeSearch
+
+
+def make_fake_youtube(config, base_url):
+    """
+    Returns a stand-in for pytubefix.YouTube whose audio stream is served by the stub server
+    """
+    session = Session()
+
+    class FakeStream:
+        subtype = 'mp4'
+
+        def __init__(self, youtube_id):
+            self.filesize = config.track_size
+            self.url = f'{base_url}/stream/{youtube_id}?size={config.track_size}'
+
+        def download(self, output_path, filename, skip_existing=True):
+            file_path = os.path.join(output_path, filename)
+            response = session.get(self.url, stream=True, timeout=60)
+            response.raise_for_status()
+            with open(file_path, 'wb') as f:
+                for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+                    f.write(chunk)
+            return file_path
+
+    class FakeStreams:
+        def __init__(self, youtube_id):
+            self.youtube_id = youtube_id
+
+        def get_audio_only(self):
+            return FakeStream(self.youtube_id)
+
+    class FakeYouTube:
+        def __init__(self, url, client=None):
+            self.video_id = parse_qs(urlsplit(url).query)['v'][0]
+            self.title = self.video_id
+            self.length = 200
+
+        @property
+        def streams(self):
+            # Video info request
+            sleep(config.info_latency)
+            if config.fails(config.stream_failure_rate):
+                raise ConnectionError(f'Video info failed for {self.video_id}')
+            return FakeStreams(self.video_id)
+
+    return FakeYouTube
+
+
+def percentile(values, p):
+    """
+    Returns the p(param)-th percentile of values (nearest rank)
+    """
+    if not values:
+        return 0
+    values = sorted(values)
+    rank = max(1, min(len(values), round(p / 100 * len(values) + 0.5)))
+    return values[rank - 1]
+
+
+def peak_rss():
+    """
+    Returns the peak resident memory (bytes) of this process
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class Command(BaseCommand):
+    help = ('Runs download_20, the celery playlist path and the archive build against local stand-ins '
+            'for Spotify and youtube and reports tracks/sec, p50/p99 job time and peak RSS')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenarios', default='metadata,download_20,celery,archive',
+                            help='comma separated : metadata, download_20, celery, archive')
+        parser.add_argument('--jobs', type=int, default=5, help='jobs run per scenario')
+        parser.add_argument('--tracks', type=int, default=20, help='tracks per download_20 job')
+        parser.add_argument('--playlist-tracks', type=int, default=60, help='tracks per celery job')
+        parser.add_argument('--spotify-latency', type=float, default=30, help='ms per Spotify request')
+        parser.add_argument('--search-latency', type=float, default=150, help='ms per youtube search')
+        parser.add_argument('--info-latency', type=float, default=80, help='ms per video info request')
+        parser.add_argument('--bandwidth', type=int, default=4096, help='KB/s per stream (0 : unlimited)')
+        parser.add_argument('--track-size', type=int, default=512, help='KB per audio stream')
+        parser.add_argument('--search-failure-rate', type=float, default=0.02)
+        parser.add_argument('--stream-failure-rate', type=float, default=0.01)
+        parser.add_argument('--reuse-tracks', action='store_true',
+                            help='every job downloads the same songs (measures the track store hits)')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--json', action='store_true', help='print the report as json')
+
+    def handle(self, *args, **options):
+        config = BenchConfig(options)
+        work_dir = tempfile.mkdtemp(prefix='savestreamz-bench-')
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(config))
+        server.daemon_threads = True
+        Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f'http://127.0.0.1:{server.server_address[1]}'
+
+        # Separate database - the benchmark never touches the real one
+        old_name = settings.DATABASES['default']['NAME']
+        settings.DATABASES['default'].setdefault('TEST', {})
+        if connection.vendor == 'sqlite':
+            settings.DATABASES['default']['TEST']['NAME'] = os.path.join(work_dir, 'bench.sqlite3')
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+
+        try:
+            self.patch_services(config, base_url, work_dir)
+            report = {}
+            for scenario in options['scenarios'].split(','):
+                scenario = scenario.strip()
+                report[scenario] = getattr(self, f'run_{scenario}')(options)
+            report['peak_rss_mb'] = round(peak_rss() / 1024 ** 2, 1)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            server.shutdown()
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            self.print_report(report)
+
+    def patch_services(self, config, base_url, work_dir):
+        """
+        Points the app at the stand-in services and a temporary track store
+        """
+        from webpage import spotify, spotify_async, resolver, track_store, tasks, helpers
+        from webpage.spotify_token import token_holder
+        from downloader.celery import app
+        from datetime import datetime, timedelta
+
+        spotify_async.SPOTIFY_API_URL = f'{base_url}/v1'
+        spotify.client.session.mount('https://accounts.spotify.com/', StubAdapter(base_url))
+        token_holder.token = 'bench'
+        token_holder.expires_at = datetime.now() + timedelta(days=1)
+
+        self.durations = {}
+        resolver.Search = make_fake_search(config, self.durations)
+        fake_youtube = make_fake_youtube(config, base_url)
+        track_store.YouTube = fake_youtube
+        tasks.YouTube = fake_youtube
+
+        track_store.FILES_DIR = os.path.join(work_dir, 'files')
+        track_store.TRACKS_DIR = os.path.join(work_dir, 'files', 'tracks')
+        self.files_dir = track_store.FILES_DIR
+        os.makedirs(self.files_dir, exist_ok=True)
+
+        # Only the stand-ins are measured - no rate limits, celery runs the tasks in this process
+        settings.RATE_LIMITS = {}
+        app.conf.task_always_eager = True
+        app.conf.task_eager_propagates = False
+        self.helpers = helpers
+        self.spotify_async = spotify_async
+
+    def song_inputs(self, playlist_id, count):
+        """
+        Returns get_song_inputs style [song_name, track_id, duration] lists of a stub playlist
+        """
+        inputs = []
+        for i in range(count):
+            track = stub_track(playlist_id, i)
+            song = f'{track["name"]} - {track["artists"][0]["name"]}'
+            self.durations[song] = round(track['duration_ms'] / 1000)
+            inputs.append([song, track['id'], round(track['duration_ms'] / 1000)])
+        return inputs
+
+    def playlist_id(self, scenario, job, tracks, reuse):
+        return f'{scenario}{0 if reuse else job}x{tracks}'
+
+    def summarize(self, job_times, tracks, failed=0):
+        total_time = sum(job_times)
+        return {
+            'jobs': len(job_times),
+            'tracks': tracks,
+            'failed_tracks': failed,
+            'tracks_per_sec': round(tracks / total_time, 2) if total_time else 0,
+            'p50_job_sec': round(percentile(job_times, 50), 3),
+            'p99_job_sec': round(percentile(job_times, 99), 3),
+        }
+
+    async def get_playlist_data(self, playlist_id):
+        """
+        Fetches a playlist's metadata the way the spotify view does (one client session per page view)
+        """
+        async with self.spotify_async.client.session():
+            return await self.helpers.aget_playlist_data('bench', playlist_id)
+
+    def run_metadata(self, options):
+        """
+        Spotify playlist metadata (async client, paged concurrently) - first fetch and cached fetch
+        """
+        job_times, cached_times = [], []
+        for job in range(options['jobs']):
+            playlist_id = self.playlist_id('m', job, options['playlist_tracks'], False)
+            start = perf_counter()
+            songs, info = asyncio.run(self.get_playlist_data(playlist_id))
+            job_times.append(perf_counter() - start)
+            start = perf_counter()
+            asyncio.run(self.get_playlist_data(playlist_id))
+            cached_times.append(perf_counter() - start)
+
+        result = self.summarize(job_times, options['jobs'] * options['playlist_tracks'])
+        result['p50_cached_sec'] = round(percentile(cached_times, 50), 3)
+        return result
+
+    def run_download_20(self, options):
+        """
+        download_20 - concurrent fetch and the streamed zip (consumed like a client would)
+        """
+        from webpage.downloader import download_20
+        import zipfile
+        import io
+
+        job_times, failed = [], 0
+        for job in range(options['jobs']):
+            playlist_id = self.playlist_id('d', job, options['tracks'], options['reuse_tracks'])
+            song_inputs = self.song_inputs(playlist_id, options['tracks'])
+            start = perf_counter()
+            response = download_20(song_inputs)
+            content = b''.join(response.streaming_content)
+            job_times.append(perf_counter() - start)
+            failed += len(song_inputs) - len(zipfile.ZipFile(io.BytesIO(content)).namelist())
+
+        return self.summarize(job_times, options['jobs'] * options['tracks'], failed)
+
+    def run_celery(self, options):
+        """
+        Celery playlist path - resolve -> download chains and finish_download (eager - one worker)
+        """
+        from webpage.models import DownloadItem
+
+        job_times, failed = [], 0
+        self.job_dirs = []
+        for job in range(options['jobs']):
+            playlist_id = self.playlist_id('c', job, options['playlist_tracks'], options['reuse_tracks'])
+            song_inputs = self.song_inputs(playlist_id, options['playlist_tracks'])
+            dir_path = os.path.join(self.files_dir, f'bench_{playlist_id}_{job}')
+            start = perf_counter()
+            job_id, dir_path, _ = self.helpers.download_song_fragment(dir_path, song_inputs, f'sp_playlist__{playlist_id}_{job}')
+            job_times.append(perf_counter() - start)
+            failed += DownloadItem.object.filter(job__job_id=job_id, status='failed').count()
+            self.job_dirs.append(dir_path)
+
+        return self.summarize(job_times, options['jobs'] * options['playlist_tracks'], failed)
+
+    def run_archive(self, options):
+        """
+        Archive build of finished job directories (runs the celery scenario first if needed)
+        """
+        from webpage.archive import build_archive, archive_path
+
+        if not getattr(self, 'job_dirs', None):
+            self.run_celery(options)
+
+        job_times, tracks = [], 0
+        for dir_path in self.job_dirs:
+            try:
+                os.remove(archive_path(dir_path))
+            except FileNotFoundError:
+                pass
+            start = perf_counter()
+            build_archive(dir_path)
+            job_times.append(perf_counter() - start)
+            tracks += len([name for name in os.listdir(dir_path) if name != '000_readme.txt'])
+
+        return self.summarize(job_times, tracks)
+
+    def print_report(self, report):
+        self.stdout.write(f'{"scenario":<12}{"jobs":>6}{"tracks":>8}{"failed":>8}{"tracks/s":>10}{"p50 (s)":>10}{"p99 (s)":>10}')
+        for scenario, result in report.items():
+            if not isinstance(result, dict):
+                continue
+            self.stdout.write(
+                f'{scenario:<12}{result["jobs"]:>6}{result["tracks"]:>8}{result["failed_tracks"]:>8}'
+                f'{result["tracks_per_sec"]:>10}{result["p50_job_sec"]:>10}{result["p99_job_sec"]:>10}'
+            )
+        if 'metadata' in report:
+            self.stdout.write(f'metadata p50 (cached) : {report["metadata"]["p50_cached_sec"]} s')
+        self.stdout.write(f'peak RSS : {report["peak_rss_mb"]} MB')
@@ -0,0 +1,33 @@
+# Generated by Django 5.1.4 on 2026-10-18 15:43
+
+import django.db.models.manager
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webpage', '0005_videolog_batch_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrackLog',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('youtube_id', models.CharField(max_length=20, unique=True)),
+                ('spotify_id', models.CharField(blank=True, db_index=True, max_length=40, null=True)),
+                ('file_path', models.CharField(max_length=600)),
+                ('ref_count', models.IntegerField(default=0)),
+                ('expires_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            managers=[
+                ('object', django.db.models.manager.Manager()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='videolog',
+            name='tracks',
+            field=models.ManyToManyField(blank=True, to='webpage.tracklog'),
+        ),
+    ]
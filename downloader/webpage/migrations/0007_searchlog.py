@@ -0,0 +1,27 @@
+# Generated by Django 5.1.4 on 2026-10-18 15:44
+
+import django.db.models.manager
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webpage', '0006_tracklog_videolog_tracks'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchLog',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('query', models.CharField(max_length=300, unique=True)),
+                ('youtube_id', models.CharField(max_length=20)),
+                ('created_at', models.DateTimeField()),
+                ('last_used_at', models.DateTimeField(db_index=True)),
+            ],
+            managers=[
+                ('object', django.db.models.manager.Manager()),
+            ],
+        ),
+    ]
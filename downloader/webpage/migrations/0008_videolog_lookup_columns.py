@@ -0,0 +1,48 @@
+# Generated by Django 5.1.4 on 2026-10-18 15:45
+
+from django.db import migrations, models
+
+
+def fill_lookup_columns(apps, schema_editor):
+    """
+    Fills source, kind and external_id of the existing logs from their file_metadata
+    """
+    VideoLog = apps.get_model('webpage', 'VideoLog')
+    logs = []
+    for log in VideoLog._default_manager.all().iterator():
+        prefix, _, external_id = log.file_metadata.partition('__')
+        log.source, _, log.kind = prefix.partition('_')
+        log.external_id = log.file_name if log.source == 'yt' else (external_id or None)
+        logs.append(log)
+
+    VideoLog._default_manager.bulk_update(logs, ['source', 'kind', 'external_id'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webpage', '0007_searchlog'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='videolog',
+            name='external_id',
+            field=models.CharField(blank=True, max_length=200, null=True),
+        ),
+        migrations.AddField(
+            model_name='videolog',
+            name='kind',
+            field=models.CharField(default='audio', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='videolog',
+            name='source',
+            field=models.CharField(default='yt', max_length=10),
+        ),
+        migrations.AddIndex(
+            model_name='videolog',
+            index=models.Index(fields=['source', 'kind', 'external_id'], name='videolog_lookup_idx'),
+        ),
+        migrations.RunPython(fill_lookup_columns, migrations.RunPython.noop),
+    ]
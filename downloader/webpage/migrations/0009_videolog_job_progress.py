@@ -0,0 +1,33 @@
+# Generated by Django 5.1.4 on 2026-10-18 15:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webpage', '0008_videolog_lookup_columns'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='videolog',
+            name='done_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='videolog',
+            name='song_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='videolog',
+            name='status',
+            field=models.CharField(default='ready', max_length=10),
+        ),
+        migrations.AlterField(
+            model_name='videolog',
+            name='batch_id',
+            field=models.CharField(blank=True, db_index=True, max_length=20, null=True),
+        ),
+    ]
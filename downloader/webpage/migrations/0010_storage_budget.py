@@ -0,0 +1,49 @@
+# Generated by Django 5.1.4 on 2026-10-18 15:51
+
+from django.db import migrations, models
+import os
+
+
+def fill_track_sizes(apps, schema_editor):
+    """
+    Fills size (from the disk) and last_used_at of the already stored tracks
+    """
+    TrackLog = apps.get_model('webpage', 'TrackLog')
+    tracks = []
+    for track in TrackLog._default_manager.all().iterator():
+        track.size = os.path.getsize(track.file_path) if os.path.exists(track.file_path) else 0
+        track.last_used_at = track.expires_at
+        tracks.append(track)
+
+    TrackLog._default_manager.bulk_update(tracks, ['size', 'last_used_at'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webpage', '0009_videolog_job_progress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tracklog',
+            name='last_used_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='tracklog',
+            name='size',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='tracklog',
+            name='expires_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='videolog',
+            name='expires_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.RunPython(fill_track_sizes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,82 @@
+# Generated by Django 5.1.4 on 2026-10-18 16:00
+
+import django.db.models.deletion
+import django.db.models.manager
+from django.db import migrations, models
+
+
+def copy_jobs(apps, schema_editor):
+    """
+    Creates a DownloadJob for every existing playlist/album directory log (progress moves off VideoLog)
+    """
+    VideoLog = apps.get_model('webpage', 'VideoLog')
+    DownloadJob = apps.get_model('webpage', 'DownloadJob')
+    jobs = [
+        DownloadJob(job_id=log.batch_id, log=log, status=log.status, total=log.song_count, done_count=log.done_count)
+        for log in VideoLog._default_manager.filter(file_type='directory', batch_id__isnull=False).iterator()
+    ]
+    DownloadJob._default_manager.bulk_create(jobs, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webpage', '0010_storage_budget'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DownloadJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('job_id', models.CharField(max_length=20, unique=True)),
+                ('status', models.CharField(db_index=True, default='pending', max_length=10)),
+                ('total', models.IntegerField(default=0)),
+                ('done_count', models.IntegerField(default=0)),
+                ('failed_count', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('log', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='job', to='webpage.videolog')),
+            ],
+            managers=[
+                ('object', django.db.models.manager.Manager()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DownloadItem',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.IntegerField()),
+                ('song_name', models.CharField(max_length=300)),
+                ('spotify_id', models.CharField(blank=True, max_length=40, null=True)),
+                ('duration', models.IntegerField(blank=True, null=True)),
+                ('status', models.CharField(default='pending', max_length=10)),
+                ('file_name', models.CharField(blank=True, max_length=310, null=True)),
+                ('error', models.CharField(blank=True, max_length=300, null=True)),
+                ('track', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='webpage.tracklog')),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='items', to='webpage.downloadjob')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['job', 'status'], name='downloaditem_status_idx')],
+            },
+            managers=[
+                ('object', django.db.models.manager.Manager()),
+            ],
+        ),
+        migrations.RunPython(copy_jobs, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='videolog',
+            name='batch_id',
+        ),
+        migrations.RemoveField(
+            model_name='videolog',
+            name='done_count',
+        ),
+        migrations.RemoveField(
+            model_name='videolog',
+            name='song_count',
+        ),
+        migrations.RemoveField(
+            model_name='videolog',
+            name='status',
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 16:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webpage', '0011_download_jobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='downloaditem',
+            name='youtube_id',
+            field=models.CharField(blank=True, max_length=20, null=True),
+        ),
+    ]
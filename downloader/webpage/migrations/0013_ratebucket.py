@@ -0,0 +1,29 @@
+# Generated by Django 5.1.4 on 2026-10-18 16:03
+
+import django.db.models.manager
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webpage', '0012_downloaditem_youtube_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RateBucket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=20, unique=True)),
+                ('tokens', models.FloatField(default=0)),
+                ('updated_at', models.FloatField(default=0)),
+                ('acquired', models.BigIntegerField(default=0)),
+                ('throttled', models.BigIntegerField(default=0)),
+                ('wait_seconds', models.FloatField(default=0)),
+            ],
+            managers=[
+                ('object', django.db.models.manager.Manager()),
+            ],
+        ),
+    ]
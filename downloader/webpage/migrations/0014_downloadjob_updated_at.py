@@ -0,0 +1,28 @@
+# Generated by Django 5.1.4 on 2026-10-18 16:15
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def fill_updated_at(apps, schema_editor):
+    """
+    Existing jobs count as last updated when they were created (see tasks.fail_stuck_items)
+    """
+    DownloadJob = apps.get_model('webpage', 'DownloadJob')
+    DownloadJob._default_manager.filter(updated_at__isnull=True).update(updated_at=F('created_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webpage', '0013_ratebucket'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='downloadjob',
+            name='updated_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(fill_updated_at, migrations.RunPython.noop),
+    ]
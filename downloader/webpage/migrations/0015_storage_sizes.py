@@ -0,0 +1,51 @@
+# Generated by Django 5.1.4 on 2026-10-18 16:18
+
+from django.db import migrations, models
+import os
+
+
+def file_size(file_path):
+    try:
+        return os.path.getsize(file_path)
+    except OSError:
+        return 0
+
+
+def fill_sizes(apps, schema_editor):
+    """
+    Records the sizes of the archives and converted tracks already on the disk (counted in the disk budget)
+    """
+    TrackLog = apps.get_model('webpage', 'TrackLog')
+    VideoLog = apps.get_model('webpage', 'VideoLog')
+
+    for track in TrackLog._default_manager.iterator():
+        base, ext = os.path.splitext(track.file_path)
+        size = sum(file_size(f'{base}.{fmt}') for fmt in ('mp3', 'm4a', 'opus') if f'.{fmt}' != ext)
+        if size:
+            TrackLog._default_manager.filter(pk=track.pk).update(converted_size=size)
+
+    for log in VideoLog._default_manager.filter(file_type='directory').iterator():
+        size = file_size(os.path.normpath(log.file_path) + '.zip')
+        if size:
+            VideoLog._default_manager.filter(pk=log.pk).update(size=size)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webpage', '0014_downloadjob_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tracklog',
+            name='converted_size',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='videolog',
+            name='size',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_sizes, migrations.RunPython.noop),
+    ]
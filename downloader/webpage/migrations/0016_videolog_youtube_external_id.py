@@ -0,0 +1,31 @@
+# Generated by Django 5.1.4 on 2026-10-18 16:40
+
+from django.db import migrations
+import os
+
+
+def strip_extensions(apps, schema_editor):
+    """
+    Youtube audio logs are looked up by their file name without the extension (see VideoLog.save) -
+    rewrites the external_id of the logs saved before that (file name with the extension)
+    """
+    VideoLog = apps.get_model('webpage', 'VideoLog')
+    logs = []
+    for log in VideoLog._default_manager.filter(source='yt', file_name__isnull=False).iterator():
+        external_id = os.path.splitext(log.file_name)[0]
+        if log.external_id != external_id:
+            log.external_id = external_id
+            logs.append(log)
+
+    VideoLog._default_manager.bulk_update(logs, ['external_id'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webpage', '0015_storage_sizes'),
+    ]
+
+    operations = [
+        migrations.RunPython(strip_extensions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 16:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webpage', '0016_videolog_youtube_external_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='downloaditem',
+            name='started_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -1,4 +1,34 @@
 from django.db import models
+import os
+
+
+def parse_file_metadata(file_metadata):
+    """
+    Splits a VideoLog file_metadata string into (source, kind, external_id)
+    (example : sp_album__123532 -> ('sp', 'album', '123532'), yt_audio -> ('yt', 'audio', None))
+    """
+    prefix, _, external_id = file_metadata.partition('__')
+    source, _, kind = prefix.partition('_')
+    return source, kind, external_id or None
+
+
+class TrackLog(models.Model):
+    """
+    TrackLog : Logs every audio track kept in the shared track store (keyed by youtube video id and spotify track id)
+    """
+    object = models.Manager()
+
+    youtube_id = models.CharField(max_length=20, unique=True)
+    spotify_id = models.CharField(max_length=40, null=True, blank=True, db_index=True)
+    file_path = models.CharField(max_length=600)
+    size = models.BigIntegerField(default=0)  # bytes
+    converted_size = models.BigIntegerField(default=0)  # bytes taken by its converted versions (see audio.convert_track)
+    ref_count = models.IntegerField(default=0)
+    last_used_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    expires_at = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    def __str__(self):
+        return self.youtube_id
 
 class VideoLog(models.Model):
     """
@@ -10,12 +40,83 @@ class VideoLog(models.Model):
     file_name = models.CharField(max_length=200, null=True, blank=True)
     file_type = models.CharField(max_length=10, default='audio')
     file_metadata = models.CharField(max_length=100, null=False, default='yt_audio')
-    expires_at = models.DateTimeField(null=True, blank=True)
-    batch_id = models.CharField(max_length=20, null=True, blank=True)
+    expires_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    tracks = models.ManyToManyField(TrackLog, blank=True)
+    # Structured (indexed) form of file_metadata - filled in on save()
+    source = models.CharField(max_length=10, default='yt')
+    kind = models.CharField(max_length=20, default='audio')
+    external_id = models.CharField(max_length=200, null=True, blank=True)
+    # Bytes of the files the log owns besides its linked tracks (the job's archive)
+    size = models.BigIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['source', 'kind', 'external_id'], name='videolog_lookup_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.source, self.kind, self.external_id = parse_file_metadata(self.file_metadata)
+        if self.source == 'yt':
+            # Youtube audio files are identified by their file name (without the extension)
+            self.external_id = os.path.splitext(self.file_name)[0]
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return self.file_metadata
 
+
+class DownloadJob(models.Model):
+    """
+    DownloadJob : A playlist/album download (one DownloadItem per song) into the directory logged by log(VideoLog)
+    """
+    object = models.Manager()
+
+    job_id = models.CharField(max_length=20, unique=True)
+    log = models.OneToOneField(VideoLog, on_delete=models.CASCADE, related_name='job')
+    # 'pending' -> 'finishing' (every item processed, readme and archive being written) -> 'ready'
+    # or 'failed' (the readme could not be written - see tasks.finish_download)
+    status = models.CharField(max_length=10, default='pending', db_index=True)
+    total = models.IntegerField(default=0)
+    # Updated atomically (F expressions) by the download tasks
+    done_count = models.IntegerField(default=0)
+    failed_count = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Time the last item was processed (set on creation too)
+    updated_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return self.job_id
+
+
+class DownloadItem(models.Model):
+    """
+    DownloadItem : A single song of a DownloadJob (status : 'pending' -> 'done' or 'failed')
+    """
+    object = models.Manager()
+
+    job = models.ForeignKey(DownloadJob, on_delete=models.CASCADE, related_name='items')
+    position = models.IntegerField()
+    song_name = models.CharField(max_length=300)
+    spotify_id = models.CharField(max_length=40, null=True, blank=True)
+    duration = models.IntegerField(null=True, blank=True)  # seconds
+    # Filled in by the resolve stage (tasks.resolve_item), read by the download stage
+    youtube_id = models.CharField(max_length=20, null=True, blank=True)
+    status = models.CharField(max_length=10, default='pending')
+    # Set while a task works on the item, None while it waits in a queue (see tasks.fail_stuck_items)
+    started_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    file_name = models.CharField(max_length=310, null=True, blank=True)
+    error = models.CharField(max_length=300, null=True, blank=True)
+    track = models.ForeignKey(TrackLog, on_delete=models.SET_NULL, null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['job', 'status'], name='downloaditem_status_idx'),
+        ]
+
+    def __str__(self):
+        return self.song_name
+
+
 class KeyLog(models.Model):
     """
     KeyLog : Tracks the spotify api key (which expires after 1 hour)
@@ -24,3 +125,34 @@ class KeyLog(models.Model):
 
     api_token = models.CharField(max_length=400)
     expires_at = models.DateTimeField(null=True, blank=True)
+
+class SearchLog(models.Model):
+    """
+    SearchLog : Caches youtube search results (normalized search query -> youtube video id)
+    """
+    object = models.Manager()
+
+    query = models.CharField(max_length=300, unique=True)
+    youtube_id = models.CharField(max_length=20)
+    created_at = models.DateTimeField()
+    last_used_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return self.query
+
+
+class RateBucket(models.Model):
+    """
+    RateBucket : Token bucket shared by every process (see rate_limit.py) along with its usage counters
+    """
+    object = models.Manager()
+
+    name = models.CharField(max_length=20, unique=True)
+    tokens = models.FloatField(default=0)
+    updated_at = models.FloatField(default=0)  # unix time of the last refill
+    acquired = models.BigIntegerField(default=0)  # calls let through
+    throttled = models.BigIntegerField(default=0)  # times a caller had to wait
+    wait_seconds = models.FloatField(default=0)  # total time callers were told to wait
+
+    def __str__(self):
+        return self.name
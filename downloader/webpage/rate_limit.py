@@ -0,0 +1,167 @@
+""" Token bucket rate limits shared by every web/celery process (youtube search, stream fetch, Spotify API) """
+from django.conf import settings
+from django.db import connection, transaction, DatabaseError, IntegrityError
+from asgiref.sync import sync_to_async
+from threading import Lock
+from time import time, sleep
+import asyncio
+
+from .models import RateBucket
+
+
+class LocalBucket:
+    """
+    In-process token bucket - used when RATE_LIMIT_BACKEND is 'local' or the database can't be used
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.tokens = None
+        self.updated_at = 0
+        self.acquired = 0
+        self.throttled = 0
+        self.wait_seconds = 0
+
+    def try_acquire(self, rate, burst):
+        with self.lock:
+            now = time()
+            if self.tokens is None:
+                self.tokens = burst
+            self.tokens = min(burst, self.tokens + (now - self.updated_at) * rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                self.acquired += 1
+                return 0
+
+            wait = (1 - self.tokens) / rate
+            self.throttled += 1
+            self.wait_seconds += wait
+            return wait
+
+
+local_buckets = {}
+local_buckets_lock = Lock()
+
+
+def get_local_bucket(name):
+    """
+    Returns the in-process bucket called name(param) (created on first use)
+    """
+    with local_buckets_lock:
+        if name not in local_buckets:
+            local_buckets[name] = LocalBucket()
+        return local_buckets[name]
+
+
+def create_bucket(name, burst):
+    """
+    Creates the (full) bucket row called name(param) on first use - returns the locked row
+    """
+    try:
+        with transaction.atomic():
+            return RateBucket.object.create(name=name, tokens=burst, updated_at=time())
+    except IntegrityError:
+        # Created by another process at the same time
+        return RateBucket.object.select_for_update().get(name=name)
+
+
+def try_acquire_db(name, rate, burst):
+    """
+    Takes a token from the shared bucket row (locked for the refill/take) - returns 0 if one was taken,
+    otherwise the time (seconds) until the next token is available
+    """
+    with transaction.atomic():
+        bucket = RateBucket.object.select_for_update().filter(name=name).first()
+        if bucket is None:
+            bucket = create_bucket(name, burst)
+        now = time()
+        tokens = min(burst, bucket.tokens + max(0, now - bucket.updated_at) * rate)
+        if tokens >= 1:
+            wait = 0
+            tokens -= 1
+            bucket.acquired += 1
+        else:
+            wait = (1 - tokens) / rate
+            bucket.throttled += 1
+            bucket.wait_seconds += wait
+        bucket.tokens = tokens
+        bucket.updated_at = now
+        bucket.save(update_fields=['tokens', 'updated_at', 'acquired', 'throttled', 'wait_seconds'])
+
+    return wait
+
+
+def try_acquire(name):
+    """
+    Takes a token from the bucket called name(param) (settings.RATE_LIMITS) - returns 0 if one was taken,
+    otherwise the time (seconds) to wait before trying again. Unlimited buckets always return 0.
+    """
+    limit = settings.RATE_LIMITS.get(name)
+    if not limit or limit['rate'] <= 0:
+        return 0
+
+    rate, burst = limit['rate'], max(1, limit['burst'])
+    if settings.RATE_LIMIT_BACKEND == 'db':
+        try:
+            return try_acquire_db(name, rate, burst)
+        except DatabaseError as e:
+            print(f'Rate limit bucket {name} not available, limiting this process only : {e}')
+
+    return get_local_bucket(name).try_acquire(rate, burst)
+
+
+def acquire(name):
+    """
+    Waits until a call is allowed by the bucket called name(param) (see settings.RATE_LIMITS)
+    """
+    wait = try_acquire(name)
+    while wait > 0:
+        sleep(wait)
+        wait = try_acquire(name)
+
+
+def try_acquire_in_thread(name):
+    """
+    try_acquire run by aacquire in a worker thread (closes the thread's db connection when done)
+    """
+    try:
+        return try_acquire(name)
+    finally:
+        connection.close()
+
+
+async def aacquire(name):
+    """
+    Async version of acquire - waits without blocking the event loop
+    """
+    wait = await sync_to_async(try_acquire_in_thread, thread_sensitive=False)(name)
+    while wait > 0:
+        await asyncio.sleep(wait)
+        wait = await sync_to_async(try_acquire_in_thread, thread_sensitive=False)(name)
+
+
+def get_metrics():
+    """
+    Returns the usage counters of every bucket
+    Example : {'search': {'acquired': 120, 'throttled': 4, 'wait_seconds': 1.5, 'shared': True}}
+    Shared (db) counters cover every process, local ones only this process.
+    """
+    metrics = {}
+    if settings.RATE_LIMIT_BACKEND == 'db':
+        try:
+            for bucket in RateBucket.object.all():
+                metrics[bucket.name] = {
+                    'acquired': bucket.acquired, 'throttled': bucket.throttled,
+                    'wait_seconds': round(bucket.wait_seconds, 3), 'shared': True
+                }
+        except DatabaseError:
+            pass
+
+    for name, bucket in local_buckets.items():
+        if name not in metrics:
+            metrics[name] = {
+                'acquired': bucket.acquired, 'throttled': bucket.throttled,
+                'wait_seconds': round(bucket.wait_seconds, 3), 'shared': False
+            }
+
+    return metrics
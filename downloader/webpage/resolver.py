@@ -0,0 +1,199 @@
+""" Resolves search queries into youtube videos (backed by a persistent search cache - SearchLog table) """
+from pytubefix import Search
+from datetime import datetime, timedelta
+from difflib import SequenceMatcher
+import re
+
+from .models import SearchLog
+from .rate_limit import acquire
+
+
+# Cached search result expiring duration in minutes
+SEARCH_EXPIRES_IN = 60 * 24 * 7
+
+# Maximum number of cached search results (least recently used ones are deleted first)
+SEARCH_CACHE_SIZE = 50000
+
+# Videos whose length differs from the Spotify duration by more than this (seconds) score nothing for duration
+DURATION_TOLERANCE = 30
+
+# Words that mark a different version of a song (penalized unless the query has them too)
+VERSION_WORDS = ('live', 'cover', 'karaoke', 'remix', 'instrumental', 'slowed', 'reverb', 'sped up',
+                 'nightcore', '8d', 'loop', 'hour', 'hours', 'reaction')
+
+# Candidates scoring below this are used only if nothing better was found
+MIN_MATCH_SCORE = 0.5
+
+
+def normalize_query(search_query):
+    """
+    Returns the search query in the form it is cached in
+    (case folded, without extra whitespace) so that equal searches share a cache entry.
+    """
+    return re.sub(r'\s+', ' ', search_query.casefold()).strip()
+
+
+def parse_length(length_text):
+    """
+    Returns the number of seconds of a youtube length text (example : 1:02:03 -> 3723), None if unknown
+    """
+    try:
+        seconds = 0
+        for part in length_text.split(':'):
+            seconds = seconds * 60 + int(part)
+    except (AttributeError, ValueError):
+        return None
+
+    return seconds
+
+
+def get_candidates(search):
+    """
+    Returns the videos of a pytubefix Search() as a list of dictionaries
+    {'video_id', 'title', 'channel', 'length'} read from the search response itself
+    (accessing title/length on the YouTube objects would fetch every video's page).
+    """
+    videos = search.videos
+    candidates = []
+    try:
+        sections = search._initial_results['contents']['twoColumnSearchResultsRenderer'][
+            'primaryContents']['sectionListRenderer']['contents']
+        for section in sections:
+            for item in section.get('itemSectionRenderer', {}).get('contents', []):
+                renderer = item.get('videoRenderer')
+                if renderer is None:
+                    continue
+                candidates.append({
+                    'video_id': renderer['videoId'],
+                    'title': ''.join(run.get('text', '') for run in renderer.get('title', {}).get('runs', [])),
+                    'channel': ''.join(run.get('text', '') for run in renderer.get('ownerText', {}).get('runs', [])),
+                    'length': parse_length(renderer.get('lengthText', {}).get('simpleText'))
+                })
+    except (AttributeError, KeyError, TypeError):
+        candidates = []
+
+    if not candidates:
+        # Unknown response layout - keep youtube's order
+        candidates = [{'video_id': video.video_id, 'title': '', 'channel': '', 'length': None} for video in videos]
+
+    return candidates
+
+
+def score_candidate(candidate, search_query, duration=None):
+    """
+    Returns how well a search result(candidate:param - see get_candidates) matches the searched track (0 - 1)
+    using the Spotify duration (seconds), title similarity and the artists' presence in the title/channel.
+    """
+    name, _, artists = search_query.partition(' - ')
+    title = normalize_query(candidate['title'])
+    channel = normalize_query(candidate['channel'])
+    name = normalize_query(name)
+
+    title_score = SequenceMatcher(None, name, title).ratio()
+    if name and name in title:
+        title_score = 1
+
+    artists = [normalize_query(artist) for artist in artists.split(',') if artist.strip()]
+    if artists:
+        artist_score = sum(1 for artist in artists if artist in title or artist in channel) / len(artists)
+    else:
+        artist_score = 0.5
+    if channel.endswith(' - topic'):
+        # Auto generated 'Artist - Topic' uploads are the studio tracks
+        artist_score = max(artist_score, 0.8)
+
+    if duration and candidate['length'] is not None:
+        duration_score = max(0, 1 - abs(candidate['length'] - duration) / DURATION_TOLERANCE)
+    else:
+        duration_score = 0.5
+
+    score = 0.5 * duration_score + 0.3 * title_score + 0.2 * artist_score
+
+    query = normalize_query(search_query)
+    for word in VERSION_WORDS:
+        if re.search(rf'\b{word}\b', title) and not re.search(rf'\b{word}\b', query):
+            score -= 0.2
+
+    return score
+
+
+def search_youtube(search_query, duration=None, bucket='search'):
+    """
+    Searches youtube for search_query(param) using a single pytubefix.Search() and returns
+    the video id of the best matching result (None if nothing was found).
+    ...
+    Parameters :
+    - search_query : '<song> - <artists>' search string
+    - duration     : length of the track in seconds (from Spotify's duration_ms) - used to skip
+                     live versions, loops etc.
+    - bucket       : rate limit bucket the search is counted in (see settings.RATE_LIMITS)
+    """
+    acquire(bucket)
+    candidates = get_candidates(Search(search_query))
+    if not candidates:
+        return None
+
+    # sorted() is stable - equal scores keep youtube's order
+    scored = sorted(candidates, key=lambda c: score_candidate(c, search_query, duration), reverse=True)
+    best = scored[0]
+    if score_candidate(best, search_query, duration) < MIN_MATCH_SCORE:
+        # Nothing matches well - fall back to youtube's top result (no second search)
+        best = candidates[0]
+
+    return best['video_id']
+
+
+def get_youtube_id(search_query, duration=None, bucket='search'):
+    """
+    Returns the youtube video id for search_query(param) from the search cache
+    or searches youtube (and caches the result) on a miss.
+    duration(param) - length of the track in seconds, bucket(param) - rate limit bucket (see search_youtube)
+    """
+    query = normalize_query(search_query)
+    curr_timestamp = datetime.now().replace(tzinfo=None)
+
+    cached = SearchLog.object.filter(
+        query=query,
+        created_at__gt=curr_timestamp - timedelta(minutes=SEARCH_EXPIRES_IN)
+    ).first()
+    if cached is not None:
+        SearchLog.object.filter(pk=cached.pk).update(last_used_at=curr_timestamp)
+        return cached.youtube_id
+
+    youtube_id = search_youtube(search_query, duration, bucket)
+    if youtube_id:
+        SearchLog.object.update_or_create(
+            query=query,
+            defaults={
+                'youtube_id': youtube_id,
+                'created_at': curr_timestamp,
+                'last_used_at': curr_timestamp
+            }
+        )
+
+    return youtube_id
+
+
+def get_youtube_url(search_query, duration=None):
+    """
+    Returns the watch URL of the youtube video found for search_query(param)
+    duration(param) - length of the track in seconds (see search_youtube)
+    """
+    youtube_id = get_youtube_id(search_query, duration)
+    if youtube_id is None:
+        raise IndexError(f'No youtube results for {search_query}')
+
+    return f'https://youtube.com/watch?v={youtube_id}'
+
+
+def clear_search_cache():
+    """
+    Deletes expired search results and keeps the cache within SEARCH_CACHE_SIZE
+    by deleting the least recently used ones.
+    """
+    curr_timestamp = datetime.now().replace(tzinfo=None)
+    SearchLog.object.filter(created_at__lt=curr_timestamp - timedelta(minutes=SEARCH_EXPIRES_IN)).delete()
+
+    oldest_kept = SearchLog.object.order_by('-last_used_at').values_list('last_used_at', flat=True)[SEARCH_CACHE_SIZE:SEARCH_CACHE_SIZE + 1]
+    if oldest_kept:
+        SearchLog.object.filter(last_used_at__lte=oldest_kept[0]).delete()
@@ -0,0 +1,166 @@
+""" Serves finished files with HTTP Range / conditional request support (or hands them to the front proxy) """
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.http import content_disposition_header, http_date, parse_http_date_safe, quote_etag
+from asgiref.sync import sync_to_async
+from urllib.parse import quote
+import mimetypes
+import os
+import re
+
+
+# Size (bytes) of the chunks read from served files
+CHUNK_SIZE = 1024 * 1024
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def file_etag(stat):
+    """
+    Returns the ETag of a file from its os.stat() result (changes whenever the file is rewritten)
+    """
+    return quote_etag(f'{stat.st_mtime_ns:x}-{stat.st_size:x}')
+
+
+def parse_range(range_header, size):
+    """
+    Returns the (start, end) byte range (end included) asked by range_header(param)
+    None if the header is absent/unsupported (whole file is sent), 'invalid' if it can't be satisfied.
+    """
+    match = RANGE_RE.match(range_header.strip()) if range_header else None
+    if match is None:
+        # Multiple ranges aren't supported - send the whole file
+        return None
+
+    start, end = match.groups()
+    if not start and not end:
+        return 'invalid'
+    if not start:
+        # Suffix range - the last n bytes
+        length = int(end)
+        if length == 0:
+            return 'invalid'
+        return max(size - length, 0), size - 1
+
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        return 'invalid'
+
+    return start, end
+
+
+def read_file(file_path, start, length):
+    """
+    Yields length(param) bytes of file_path starting at start(param) chunk by chunk
+    """
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+async def aiter_chunks(iterator):
+    """
+    Async iterator over a blocking iterator(param) - every chunk is read in a worker thread
+    """
+    iterator = iter(iterator)
+    while True:
+        chunk = await sync_to_async(next, thread_sensitive=False)(iterator, None)
+        if chunk is None:
+            break
+        yield chunk
+
+
+def asgi_stream(request, response):
+    """
+    Makes a StreamingHttpResponse send its content chunk by chunk when served over ASGI and returns it
+    (Django reads a sync iterator whole - sync_to_async(list) - before handing it to an ASGI server)
+    """
+    if isinstance(request, ASGIRequest) and getattr(response, 'streaming', False) and not response.is_async:
+        response.streaming_content = aiter_chunks(response.streaming_content)
+
+    return response
+
+
+def offload_response(file_path):
+    """
+    Returns a response that lets the front proxy send the file (settings.FILE_OFFLOAD)
+    'x-accel' : nginx X-Accel-Redirect (FILES_DIR mapped to settings.FILE_OFFLOAD_PREFIX)
+    'x-sendfile' : apache/lighttpd X-Sendfile
+    """
+    from .track_store import FILES_DIR
+
+    response = HttpResponse()
+    if settings.FILE_OFFLOAD == 'x-accel':
+        rel_path = os.path.relpath(file_path, FILES_DIR).replace(os.sep, '/')
+        response['X-Accel-Redirect'] = settings.FILE_OFFLOAD_PREFIX.rstrip('/') + '/' + quote(rel_path)
+    else:
+        response['X-Sendfile'] = file_path
+    # The proxy fills in the content type/length and handles ranges
+    del response['Content-Type']
+
+    return response
+
+
+def file_response(request, file_path, filename, content_type=None):
+    """
+    Returns a response that sends file_path(param) as an attachment named filename(param)
+    supporting Range (206 partial content), If-Range, If-None-Match and If-Modified-Since.
+    ...
+    Parameters :
+    - request      : Django request
+    - file_path    : absolute path of the file to send
+    - filename     : name the client saves the file under
+    - content_type : content type (guessed from filename by default)
+    """
+    stat = os.stat(file_path)
+    size = stat.st_size
+    etag = file_etag(stat)
+    last_modified = http_date(stat.st_mtime)
+
+    if content_type is None:
+        content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+    # Conditional GET
+    if_none_match = request.headers.get('If-None-Match')
+    if_modified_since = parse_http_date_safe(request.headers.get('If-Modified-Since', ''))
+    if (if_none_match and etag in [tag.strip() for tag in if_none_match.split(',')]) or \
+            (not if_none_match and if_modified_since and int(stat.st_mtime) <= if_modified_since):
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+
+    if settings.FILE_OFFLOAD:
+        response = offload_response(file_path)
+    else:
+        byte_range = parse_range(request.headers.get('Range'), size)
+        # If-Range - only resume if the file did not change since the first part was sent
+        if_range = request.headers.get('If-Range')
+        if byte_range is not None and if_range and if_range not in (etag, last_modified):
+            byte_range = None
+
+        if byte_range == 'invalid':
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+
+        start, end = byte_range if byte_range else (0, size - 1)
+        length = end - start + 1
+        response = asgi_stream(request, StreamingHttpResponse(read_file(file_path, start, length), content_type=content_type))
+        response['Content-Length'] = str(length)
+        if byte_range:
+            response.status_code = 206
+            response['Content-Range'] = f'bytes {start}-{end}/{size}'
+
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = last_modified
+    response['Content-Disposition'] = content_disposition_header(True, filename)
+
+    return response
@@ -1,15 +1,102 @@
 import os
-from requests import get, post
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
 from json import loads
 from base64 import b64encode
 from dotenv import load_dotenv
 from urllib.parse import urlparse
+from threading import BoundedSemaphore
+from time import sleep
+from .rate_limit import acquire
 load_dotenv()
 
 # From .env file
 client_id = os.getenv('CLIENT_ID')
 client_secret = os.getenv('CLIENT_SECRET')
 
+# Spotify API client settings
+SPOTIFY_TIMEOUT = 10  # seconds
+SPOTIFY_MAX_RETRIES = 5
+SPOTIFY_BACKOFF = 0.5  # seconds (doubled after every retry)
+SPOTIFY_MAX_CONCURRENCY = 8  # requests in flight at the same time (per process)
+SPOTIFY_MAX_RETRY_AFTER = 10  # seconds - longer Retry-After waits are not retried (the 429 response is returned)
+
+
+def retry_delay(attempt, backoff, response=None):
+    """
+    Returns the time (seconds) to wait before retrying attempt(param) - None if the response's
+    Retry-After is longer than SPOTIFY_MAX_RETRY_AFTER (a page view or task would hang for minutes).
+    Shared by SpotifyClient and spotify_async.AsyncSpotifyClient.
+    ...
+    Parameters :
+    - attempt  : number of the failed attempt (0 for the first one)
+    - backoff  : delay (seconds) of the first retry, doubled after every retry
+    - response : 429/5xx response of the attempt (None for connection errors/timeouts)
+    """
+    if response is not None and response.headers.get('Retry-After'):
+        try:
+            delay = float(response.headers['Retry-After'])
+        except ValueError:
+            delay = None
+        if delay is not None:
+            return delay if delay <= SPOTIFY_MAX_RETRY_AFTER else None
+    return backoff * 2 ** attempt
+
+
+class SpotifyClient:
+    """
+    Blocking Spotify client used for the api token (see get_token) - the API calls go through spotify_async.
+    Reuses connections (requests.Session), applies timeouts, retries 429/5xx responses with exponential
+    backoff (honoring Retry-After up to SPOTIFY_MAX_RETRY_AFTER) and caps the number of requests in flight.
+    """
+    def __init__(self, timeout=SPOTIFY_TIMEOUT, max_retries=SPOTIFY_MAX_RETRIES,
+                 backoff=SPOTIFY_BACKOFF, max_concurrency=SPOTIFY_MAX_CONCURRENCY):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.slots = BoundedSemaphore(max_concurrency)
+
+        self.session = Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=max_concurrency)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, url, **kwargs):
+        """
+        Sends a request (retrying it if needed) and returns the last response
+        """
+        for attempt in range(self.max_retries + 1):
+            acquire('spotify')
+            try:
+                with self.slots:
+                    response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            except (ConnectionError, Timeout):
+                if attempt == self.max_retries:
+                    raise
+                sleep(retry_delay(attempt, self.backoff))
+                continue
+
+            if response.status_code == 429 or response.status_code >= 500:
+                delay = retry_delay(attempt, self.backoff, response)
+                if attempt == self.max_retries or delay is None:
+                    break
+                sleep(delay)
+                continue
+
+            break
+
+        return response
+
+    def post(self, url, **kwargs):
+        """
+        Sends a POST request (used to get the api token)
+        """
+        return self.request('POST', url, **kwargs)
+
+
+# Shared by every thread of the process
+client = SpotifyClient()
+
 def get_token():
     """
     returns a spotify token
@@ -25,7 +112,7 @@ def get_token():
         'Content-Type': 'application/x-www-form-urlencoded'
     }
     data = {'grant_type': 'client_credentials'}
-    res = post(url, data=data, headers=headers)
+    res = client.post(url, data=data, headers=headers)
     json_res = loads(res.content)
     token = json_res["access_token"]
 
@@ -39,172 +126,108 @@ def get_auth_header(token):
     return {'Authorization': 'Bearer ' + token}
 
 
-def get_playlist_info(token, pl_id):
+# Only the playlist fields that are used are requested (the playlist object also holds its first 100 tracks)
+PLAYLIST_INFO_FIELDS = 'name,images(url),owner(display_name,external_urls)'
+
+
+def parse_playlist_info(json_res):
+    """
+    Returns the info list of a playlist from its Spotify API json (see spotify_async.get_playlist_info)
     """
-    Returns a list with playlist info
-    ...
-    Parameter :
-    - token   : Spotify api token
-    - pl_id   : Spotify's playlist id
-    Return Example
-    [playlist_name, playlist_cover url, owner's display name, link_to_that profile]
-    """
-    url = f'https://api.spotify.com/v1/playlists/{pl_id}'
-    header = get_auth_header(token)
     info = []
-
-    res = get(url=url, headers=header)
-    if res.status_code == 200:
-        json_res = res.json()
-        info.append(json_res['name']) # playlist name
-        info.append(json_res['images'][0]['url']) # Playlist cover link
-        info.append(json_res['owner']['display_name']) # owner's display name
-        info.append(json_res['owner']['external_urls']['spotify']) # profile link
+    info.append(json_res['name']) # playlist name
+    info.append(json_res['images'][0]['url']) # Playlist cover link
+    info.append(json_res['owner']['display_name']) # owner's display name
+    info.append(json_res['owner']['external_urls']['spotify']) # profile link
 
     return info
 
 
-def get_track_info(token, track_api=None, track_id=None):
+def parse_track_info(res_json):
     """
-    NOTE : Pass anyone parameter either track_api or track_id - By default it uses track_api link
-    ...
-    Parameter :
-    - token     : Spotify API token
-    - track_api : A Spotify track's api link
-    - track_id  : A Spotify track's id
-    Returns the info of a track using track_api_endpoint or track_id(param) and token(param)
-    Example : [track_name, cover_url, artists, spotify_url, track_id]
+    Returns the info dictionary of a track from its Spotify API json (see spotify_async.get_track_info)
     """
-    if track_id is not None:
-        url = f'https://api.spotify.com/v1/tracks/{track_id}'
-    else:
-        url = track_api
-
-    header = get_auth_header(token)
-    response = get(url=url, headers=header)
-
     result = {}
-    if response.status_code == 200:
-        res_json = response.json()
-        result['name'] = res_json['name']  # Track name
-        result['cover_url'] = res_json['album']['images'][0]['url'] # Album cover url
-        artists = ''
-        for artist in  res_json['artists']:
-            if artists:
-                artists += ', ' + artist['name']  # artists
-            else:
-                artists += artist['name']  # artists
-        result['artists'] = artists
-        result['spotify_link'] = res_json['external_urls']['spotify'] # spotify url
-        result['track_id'] = urlparse(result['spotify_link']).path.split('/')[-1]
-    else:
-        result = None
+    result['name'] = res_json['name']  # Track name
+    result['cover_url'] = res_json['album']['images'][0]['url'] # Album cover url
+    artists = ''
+    for artist in  res_json['artists']:
+        if artists:
+            artists += ', ' + artist['name']  # artists
+        else:
+            artists += artist['name']  # artists
+    result['artists'] = artists
+    result['spotify_link'] = res_json['external_urls']['spotify'] # spotify url
+    result['track_id'] = urlparse(result['spotify_link']).path.split('/')[-1]
+    result['duration_ms'] = res_json['duration_ms']
 
     return result
 
 
-def get_playlist_tracks(token, pl_id):
+# Only the track fields that are used are requested from the playlist tracks endpoint
+PLAYLIST_TRACK_FIELDS = 'total,items(track(name,id,href,duration_ms,artists(name)))'
+PLAYLIST_PAGE_SIZE = 100
+
+
+def parse_playlist_tracks(pages):
     """
-    Uses token and pl_id(spotify playlist's id) from params
-    to get info of a playlist using Spotify API.
-    ...
-    Parameters :
-    - token    : Spotify API token
-    - pl_id    : Spotify playlist's id
-    Returns a list containing tuples for each track:
-     (song_index(int), song_name(str), artists(str), track_api_link)
+    Returns the track tuples (see spotify_async.get_playlist_tracks) of a playlist from the json of all its pages
     """
-    url = f'https://api.spotify.com/v1/playlists/{pl_id}'
-    header = get_auth_header(token)
     song_artist = []
-    count = 0
-
-    while url:
-        # print(url)
-        res = get(url=url, headers=header)
-        if res.status_code == 200:
-            json_res = res.json()
-            # If the playlist contains more than 100 tracks
-            # the response changes so exception handling
-            try:
-                json_res['tracks']['items']
-            except KeyError:
-                items = json_res['items']
-            else:
-                items = json_res['tracks']['items']
-
-            for idx, i in enumerate(items, start=count + 1):
-                song_name = i['track']['name']
-                track_api_link = i['track']['href']
-                artists = ''
-                for artist in i['track']['artists']:
-                    if artists:
-                        artists += ', ' + artist['name']
-                    else:
-                        artists += artist['name']
+    for page_no, page in enumerate(pages):
+        for idx, i in enumerate(page['items'], start=page_no * PLAYLIST_PAGE_SIZE + 1):
+            # Removed and local tracks can't be downloaded
+            if not i['track'] or not i['track']['href']:
+                continue
+            song_name = i['track']['name']
+            track_api_link = i['track']['href']
+            artists = ''
+            for artist in i['track']['artists']:
+                if artists:
+                    artists += ', ' + artist['name']
+                else:
+                    artists += artist['name']
 
-                song_artist.append((idx, song_name, artists, track_api_link))
-                count = idx
-
-            try:
-                json_res['tracks']['next']
-            except KeyError:
-                url = json_res['next']
-            else:
-                url = json_res['tracks']['next']
-        else:
-            print(res.status_code)
-            break
+            song_artist.append((idx, song_name, artists, track_api_link, i['track']['duration_ms']))
 
     return song_artist
 
 
-def get_album_info(token, album_id):
+def parse_album_info(res_json):
     """
-    Returns the info of an album using spotify_token(param) and album_id(param)
-    info : [album_name, cover_url, artists, spotify_url]
+    Returns the info list of an album from its Spotify API json (see spotify_async.get_album_info)
     """
     result = []
-    url = f'https://api.spotify.com/v1/albums/{album_id}'
-    header = get_auth_header(token)
-    response = get(url=url, headers=header)
-    if response.status_code == 200:
-        res_json = response.json()
-        result.append(res_json["name"])
-        result.append(res_json["images"][0]["url"])
-        artists = ''
-        for artist in res_json["artists"]:
-            artists += artist["name"]
-        result.append(artists)
-        result.append(res_json["external_urls"]["spotify"])
+    result.append(res_json["name"])
+    result.append(res_json["images"][0]["url"])
+    artists = ''
+    for artist in res_json["artists"]:
+        artists += artist["name"]
+    result.append(artists)
+    result.append(res_json["external_urls"]["spotify"])
 
     return result
 
 
-def get_album_tracks(token, album_id):
+# Page size of the album tracks endpoint
+ALBUM_PAGE_SIZE = 50
+
+
+def parse_album_tracks(pages):
     """
-    Uses token and album_id(spotify album's id) from params
-    to get info of an album using Spotify API.
-    Returns a list containing tuples for each track:
-    (song_index(int), song_name(str), artists(str), track_api_link)
+    Returns the track tuples (see spotify_async.get_album_tracks) of an album from the json of all its track pages
     """
-    url = f'https://api.spotify.com/v1/albums/{album_id}'
-    header = get_auth_header(token)
-    response = get(url=url, headers=header)
     tracks_info = []
-
-    if response.status_code == 200:
-        res_json = response.json()
-        songs = res_json["tracks"]["items"]
-        for i, song in enumerate(songs, start=1):
-            song_name = song["name"]
-            artists = ''
-            for artist in song["artists"]:
-                if artists:
-                    artists += ', ' + artist["name"]
-                else:
-                    artists += artist["name"]
-            track_api_link = song["href"]
-            tracks_info.append((i, song_name, artists, track_api_link))
+    songs = [song for page in pages for song in page["items"]]
+    for i, song in enumerate(songs, start=1):
+        song_name = song["name"]
+        artists = ''
+        for artist in song["artists"]:
+            if artists:
+                artists += ', ' + artist["name"]
+            else:
+                artists += artist["name"]
+        track_api_link = song["href"]
+        tracks_info.append((i, song_name, artists, track_api_link, song["duration_ms"]))
 
     return tracks_info
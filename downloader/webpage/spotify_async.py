@@ -0,0 +1,272 @@
+""" Async (asyncio) Spotify API client used by the async views - the Spotify API calls of the app (parsing in spotify.py) """
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from functools import wraps
+import asyncio
+import aiohttp
+
+from .rate_limit import aacquire
+from .spotify import (
+    SPOTIFY_TIMEOUT, SPOTIFY_MAX_RETRIES, SPOTIFY_BACKOFF, SPOTIFY_MAX_CONCURRENCY, retry_delay,
+    PLAYLIST_INFO_FIELDS, PLAYLIST_TRACK_FIELDS, PLAYLIST_PAGE_SIZE, ALBUM_PAGE_SIZE,
+    get_auth_header, parse_track_info, parse_playlist_info, parse_playlist_tracks,
+    parse_album_info, parse_album_tracks
+)
+
+
+# Base url of the Spotify Web API (read at call time - the benchmark points it at its stub server)
+SPOTIFY_API_URL = 'https://api.spotify.com/v1'
+
+# Session of the current page view (see AsyncSpotifyClient.session)
+current_session = ContextVar('spotify_session', default=None)
+
+
+class SpotifyResponse:
+    """
+    Status code and json body of a Spotify API response (read before the connection is released)
+    """
+    def __init__(self, status_code, data, headers):
+        self.status_code = status_code
+        self.data = data
+        self.headers = headers
+
+    def json(self):
+        return self.data
+
+
+class AsyncSpotifyClient:
+    """
+    Async Spotify API client - one aiohttp session per page view (connections reused by its requests
+    and closed with it), timeouts, retries of 429/5xx responses with exponential backoff (honoring Retry-After)
+    and a cap on the number of requests in flight (see spotify.SpotifyClient).
+    """
+    def __init__(self, timeout=SPOTIFY_TIMEOUT, max_retries=SPOTIFY_MAX_RETRIES,
+                 backoff=SPOTIFY_BACKOFF, max_concurrency=SPOTIFY_MAX_CONCURRENCY):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_concurrency = max_concurrency
+
+    @asynccontextmanager
+    async def session(self):
+        """
+        Opens the session used by every request sent inside the block (including concurrent ones)
+        and closes it on exit. Sessions can't outlive their event loop - WSGI/runserver runs every
+        async view in a new one.
+        """
+        if current_session.get() is not None:
+            # Nested - the outer block's session is used
+            yield current_session.get()
+            return
+
+        async with aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            # The connection limit caps the requests in flight
+            connector=aiohttp.TCPConnector(limit=self.max_concurrency)
+        ) as session:
+            token = current_session.set(session)
+            try:
+                yield session
+            finally:
+                current_session.reset(token)
+
+    async def request(self, method, url, **kwargs):
+        """
+        Sends a request (retrying it if needed) and returns the last response
+        (outside of a session() block the request gets a session of its own)
+        """
+        session = current_session.get()
+        if session is None:
+            async with self.session():
+                return await self.request(method, url, **kwargs)
+
+        for attempt in range(self.max_retries + 1):
+            await aacquire('spotify')
+            try:
+                async with session.request(method, url, **kwargs) as res:
+                    data = await res.json(content_type=None) if res.status == 200 else None
+                    response = SpotifyResponse(res.status, data, res.headers)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(retry_delay(attempt, self.backoff))
+                continue
+
+            if response.status_code == 429 or response.status_code >= 500:
+                delay = retry_delay(attempt, self.backoff, response)
+                if attempt == self.max_retries or delay is None:
+                    break
+                await asyncio.sleep(delay)
+                continue
+
+            break
+
+        return response
+
+    async def get(self, url, token, **kwargs):
+        """
+        Sends an authorized GET request to the Spotify API
+        """
+        return await self.request('GET', url, headers=get_auth_header(token), **kwargs)
+
+
+# Shared by every request of the process
+client = AsyncSpotifyClient()
+
+
+def with_session(view):
+    """
+    Decorator - runs an async view inside a client.session() block (one session per page view)
+    """
+    @wraps(view)
+    async def wrapper(*args, **kwargs):
+        async with client.session():
+            return await view(*args, **kwargs)
+
+    return wrapper
+
+
+async def get_playlist_snapshot(token, pl_id):
+    """
+    Returns the snapshot_id (version of the playlist - changes whenever its tracks change)
+    of a playlist or None if it could not be fetched.
+    """
+    url = f'{SPOTIFY_API_URL}/playlists/{pl_id}'
+    res = await client.get(url, token, params={'fields': 'snapshot_id'})
+    if res.status_code == 200:
+        return res.json()['snapshot_id']
+
+    return None
+
+
+async def get_playlist_info(token, pl_id):
+    """
+    Returns a list with playlist info
+    ...
+    Parameter :
+    - token   : Spotify api token
+    - pl_id   : Spotify's playlist id
+    Return Example
+    [playlist_name, playlist_cover url, owner's display name, link_to_that profile]
+    """
+    url = f'{SPOTIFY_API_URL}/playlists/{pl_id}'
+    res = await client.get(url, token, params={'fields': PLAYLIST_INFO_FIELDS})
+    if res.status_code == 200:
+        return parse_playlist_info(res.json())
+
+    return []
+
+
+async def get_track_info(token, track_api=None, track_id=None):
+    """
+    NOTE : Pass anyone parameter either track_api or track_id - By default it uses track_api link
+    ...
+    Parameter :
+    - token     : Spotify API token
+    - track_api : A Spotify track's api link
+    - track_id  : A Spotify track's id
+    Returns the info of a track using track_api_endpoint or track_id(param) and token(param)
+    Example : {'name', 'cover_url', 'artists', 'spotify_link', 'track_id', 'duration_ms'} (see spotify.parse_track_info)
+    """
+    if track_id is not None:
+        url = f'{SPOTIFY_API_URL}/tracks/{track_id}'
+    else:
+        url = track_api
+
+    response = await client.get(url, token)
+    if response.status_code == 200:
+        return parse_track_info(response.json())
+
+    return None
+
+
+async def get_playlist_page(token, pl_id, offset):
+    """
+    Returns the json of one page (PLAYLIST_PAGE_SIZE tracks starting at offset) of a playlist's tracks
+    or None if it could not be fetched.
+    """
+    url = f'{SPOTIFY_API_URL}/playlists/{pl_id}/tracks'
+    params = {'offset': offset, 'limit': PLAYLIST_PAGE_SIZE, 'fields': PLAYLIST_TRACK_FIELDS}
+    res = await client.get(url, token, params=params)
+    if res.status_code != 200:
+        print(f'Unable to get playlist tracks (offset {offset}) : {res.status_code}')
+        return None
+
+    return res.json()
+
+
+async def get_playlist_tracks(token, pl_id):
+    """
+    Uses token and pl_id(spotify playlist's id) from params
+    to get info of a playlist using Spotify API.
+    The first page gives the total number of tracks, the remaining pages are fetched concurrently.
+    ...
+    Parameters :
+    - token    : Spotify API token
+    - pl_id    : Spotify playlist's id
+    Returns a list containing tuples for each track:
+     (song_index(int), song_name(str), artists(str), track_api_link, duration_ms(int))
+    """
+    first_page = await get_playlist_page(token, pl_id, 0)
+    if first_page is None:
+        return []
+
+    offsets = range(PLAYLIST_PAGE_SIZE, first_page['total'], PLAYLIST_PAGE_SIZE)
+    pages = [first_page] + list(await asyncio.gather(*[get_playlist_page(token, pl_id, offset) for offset in offsets]))
+
+    if None in pages:
+        # Never return a truncated playlist
+        return []
+
+    return parse_playlist_tracks(pages)
+
+
+async def get_album_info(token, album_id):
+    """
+    Returns the info of an album using spotify_token(param) and album_id(param)
+    info : [album_name, cover_url, artists, spotify_url]
+    """
+    url = f'{SPOTIFY_API_URL}/albums/{album_id}'
+    response = await client.get(url, token)
+    if response.status_code == 200:
+        return parse_album_info(response.json())
+
+    return []
+
+
+async def get_album_page(token, album_id, offset):
+    """
+    Returns the json of one page (ALBUM_PAGE_SIZE tracks starting at offset) of an album's tracks
+    or None if it could not be fetched.
+    """
+    url = f'{SPOTIFY_API_URL}/albums/{album_id}/tracks'
+    response = await client.get(url, token, params={'offset': offset, 'limit': ALBUM_PAGE_SIZE})
+    if response.status_code != 200:
+        print(f'Unable to get album tracks (offset {offset}) : {response.status_code}')
+        return None
+
+    return response.json()
+
+
+async def get_album_tracks(token, album_id):
+    """
+    Uses token and album_id(spotify album's id) from params
+    to get info of an album using Spotify API.
+    The album gives the first page and the total number of tracks, the remaining pages are fetched concurrently.
+    Returns a list containing tuples for each track:
+    (song_index(int), song_name(str), artists(str), track_api_link, duration_ms(int))
+    """
+    url = f'{SPOTIFY_API_URL}/albums/{album_id}'
+    response = await client.get(url, token)
+    if response.status_code != 200:
+        return []
+
+    first_page = response.json()["tracks"]
+    offsets = range(len(first_page["items"]), first_page["total"], ALBUM_PAGE_SIZE)
+    pages = [first_page] + list(await asyncio.gather(*[get_album_page(token, album_id, offset) for offset in offsets]))
+
+    if None in pages:
+        # Never return a truncated album
+        return []
+
+    return parse_album_tracks(pages)
@@ -0,0 +1,107 @@
+""" Process-local Spotify API token (shared between processes through the KeyLog table) """
+from django.db import connection
+from datetime import datetime, timedelta
+from threading import Lock, Thread, Timer
+
+from .models import KeyLog
+from .spotify import get_token
+
+
+# Spotify API token lifetime in seconds
+TOKEN_EXPIRES_IN = 3600
+
+# A token is replaced this many seconds before it expires
+TOKEN_REFRESH_MARGIN = 300
+
+
+class TokenHolder:
+    """
+    Keeps the Spotify API token in memory and refreshes it in the background before it expires.
+    Only one refresh runs at a time (others wait for it / use the current token).
+    """
+    def __init__(self, refresh_margin=TOKEN_REFRESH_MARGIN):
+        self.refresh_margin = timedelta(seconds=refresh_margin)
+        self.token = None
+        self.expires_at = None
+        self.lock = Lock()
+        self.timer = None
+
+    def is_fresh(self):
+        """
+        Returns True if the held token does not need to be refreshed yet
+        """
+        return self.token is not None and datetime.now() < self.expires_at - self.refresh_margin
+
+    def get(self):
+        """
+        Returns a valid token - waits only if this process has no usable token at all
+        """
+        if self.is_fresh():
+            return self.token
+
+        if self.token is not None and datetime.now() < self.expires_at:
+            # Still valid - refresh it without making the caller wait
+            self.refresh_in_background()
+            return self.token
+
+        with self.lock:
+            if not self.is_fresh():
+                self.refresh()
+
+        return self.token
+
+    def refresh(self):
+        """
+        Loads the newest token from the KeyLog table (or gets a new one from Spotify if it is about to expire)
+        and schedules the next refresh. Must be called holding self.lock.
+        """
+        curr_timestamp = datetime.now().replace(tzinfo=None)
+        key = KeyLog.object.filter(
+            expires_at__gt=curr_timestamp + self.refresh_margin
+        ).order_by('-expires_at').first()
+
+        if key is None:
+            key = KeyLog(
+                api_token=get_token(),
+                expires_at=curr_timestamp + timedelta(seconds=TOKEN_EXPIRES_IN)
+            )
+            key.save()
+            KeyLog.object.filter(expires_at__lt=curr_timestamp).delete()
+
+        self.token = key.api_token
+        self.expires_at = key.expires_at.replace(tzinfo=None)
+        self.schedule_refresh()
+
+    def schedule_refresh(self):
+        """
+        Refreshes the token (in a background thread) just before it needs to be replaced
+        """
+        if self.timer is not None:
+            self.timer.cancel()
+        delay = (self.expires_at - self.refresh_margin - datetime.now()).total_seconds()
+        self.timer = Timer(max(delay, 0) + 1, self.refresh_in_background)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def refresh_in_background(self):
+        """
+        Starts a refresh unless one is already running
+        """
+        if not self.lock.acquire(blocking=False):
+            return
+
+        def run():
+            try:
+                if not self.is_fresh():
+                    self.refresh()
+            except Exception as e:
+                print(f'Unable to refresh spotify token : {e}')
+            finally:
+                self.lock.release()
+                connection.close()
+
+        Thread(target=run, daemon=True).start()
+
+
+# Shared by every thread of the process
+token_holder = TokenHolder()
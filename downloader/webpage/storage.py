@@ -0,0 +1,184 @@
+""" Keeps the downloaded files (files directory and track store) within their time and disk budgets """
+from django.conf import settings
+from django.db.models import Sum, F, Q
+from datetime import datetime, timedelta
+from shutil import rmtree
+import os
+
+from .models import VideoLog, TrackLog
+from .track_store import release_tracks
+from . import track_store
+from .archive import archive_path
+from .audio import AUDIO_FORMATS
+
+
+# Number of rows deleted per query
+DELETE_BATCH_SIZE = 100
+
+# Files/directories younger than this (minutes) are never treated as orphans (they may be in progress)
+ORPHAN_GRACE_PERIOD = 60
+
+# Unreferenced tracks used within this time (minutes) are never evicted
+# (just stored/fetched - about to be linked to their job or converted)
+TRACK_GRACE_PERIOD = 10
+
+
+def delete_logs(logs):
+    """
+    Deletes the files/directories of logs(param - VideoLog queryset or list) along with the logs
+    and releases the tracks they reference. Safe to run more than once on the same logs.
+    """
+    logs = list(logs)
+
+    # Claim the logs so that an overlapping run doesn't release their tracks twice
+    for log in logs:
+        if not VideoLog.object.filter(pk=log.pk, expires_at__isnull=False).update(expires_at=None):
+            continue
+
+        if log.file_type == 'directory':
+            rmtree(log.file_path, ignore_errors=True)
+            try:
+                os.remove(archive_path(log.file_path))
+            except FileNotFoundError:
+                pass
+        else:
+            try:
+                os.remove(os.path.join(log.file_path, log.file_name))
+            except FileNotFoundError:
+                pass
+        release_tracks(log)
+
+    VideoLog.object.filter(pk__in=[log.pk for log in logs], expires_at__isnull=True).delete()
+
+
+def delete_tracks(tracks):
+    """
+    Deletes the stored tracks(param - TrackLog queryset or list) from the disk and the db
+    """
+    tracks = list(tracks)
+    for track in tracks:
+        # The stored track and its converted versions (see audio.convert_track)
+        for file_path in [track.file_path] + [f'{os.path.splitext(track.file_path)[0]}.{ext}' for ext in AUDIO_FORMATS]:
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+
+    TrackLog.object.filter(pk__in=[track.pk for track in tracks]).delete()
+
+
+def clear_expired_logs():
+    """
+    Deletes the contents of a file if the logged(VideoLog db) time expires (batched, uses the expires_at index)
+    """
+    curr_timestamp = datetime.now().replace(tzinfo=None)
+    while True:
+        expired = VideoLog.object.filter(expires_at__lt=curr_timestamp).order_by('expires_at')[:DELETE_BATCH_SIZE]
+        expired = list(expired)
+        if not expired:
+            break
+        delete_logs(expired)
+
+
+def clear_unused_tracks():
+    """
+    Deletes the stored tracks that are no longer referenced by any job and have expired.
+    """
+    curr_timestamp = datetime.now().replace(tzinfo=None)
+    while True:
+        unused = TrackLog.object.filter(ref_count__lte=0, expires_at__lt=curr_timestamp)[:DELETE_BATCH_SIZE]
+        unused = list(unused)
+        if not unused:
+            break
+        delete_tracks(unused)
+
+
+def used_space():
+    """
+    Returns the number of bytes taken by the track store (stored tracks and their converted versions)
+    and the job archives (job directories and single files are hard links to stored tracks)
+    """
+    tracks = TrackLog.object.aggregate(total=Sum(F('size') + F('converted_size')))['total'] or 0
+    archives = VideoLog.object.aggregate(total=Sum('size'))['total'] or 0
+
+    return tracks + archives
+
+
+def unused_tracks(last_used_before):
+    """
+    Returns the stored tracks no job references that were last used before last_used_before(param - datetime)
+    """
+    return TrackLog.object.filter(Q(last_used_at__lt=last_used_before) | Q(last_used_at__isnull=True), ref_count__lte=0)
+
+
+def enforce_disk_budget(budget=None):
+    """
+    Deletes the least recently used files until the track store and archives fit within budget(param - bytes).
+    Unreferenced tracks not used for TRACK_GRACE_PERIOD go first, then the finished jobs that expire soonest
+    (ready jobs only) along with the tracks only they referenced.
+    """
+    if budget is None:
+        budget = settings.FILES_DISK_BUDGET
+    used = used_space()
+    started_at = datetime.now().replace(tzinfo=None)
+
+    while used > budget:
+        cutoff = datetime.now().replace(tzinfo=None) - timedelta(minutes=TRACK_GRACE_PERIOD)
+        unused = list(unused_tracks(cutoff).order_by('last_used_at')[:DELETE_BATCH_SIZE])
+        if unused:
+            # Only as many tracks as needed
+            victims = []
+            for track in unused:
+                victims.append(track)
+                used -= track.size + track.converted_size
+                if used <= budget:
+                    break
+            delete_tracks(victims)
+        else:
+            oldest = VideoLog.object.filter(expires_at__isnull=False).exclude(job__status__in=['pending', 'finishing']).order_by('expires_at').first()
+            if oldest is None:
+                # Everything left belongs to jobs in progress
+                break
+            released = list(oldest.tracks.values_list('pk', flat=True))
+            delete_logs([oldest])
+            # The job's own tracks skip the grace period unless a job fetched them meanwhile
+            delete_tracks(unused_tracks(started_at).filter(pk__in=released))
+        used = used_space()
+
+
+def sweep_orphans():
+    """
+    Deletes files and directories that no log knows about
+    (left behind by crashed jobs, interrupted downloads or deleted rows).
+    """
+    older_than = (datetime.now() - timedelta(minutes=ORPHAN_GRACE_PERIOD)).timestamp()
+    files_dir, tracks_dir = track_store.FILES_DIR, track_store.TRACKS_DIR
+    if not os.path.isdir(files_dir):
+        return
+
+    # Job directories and single files
+    known_dirs = set(os.path.normpath(p) for p in VideoLog.object.filter(file_type='directory').values_list('file_path', flat=True))
+    known_files = set(VideoLog.object.exclude(file_type='directory').values_list('file_name', flat=True))
+    known_files.update(os.path.basename(archive_path(p)) for p in known_dirs)
+    for entry in os.scandir(files_dir):
+        if os.path.normpath(entry.path) == os.path.normpath(tracks_dir) or entry.stat().st_mtime > older_than:
+            continue
+        if entry.is_dir() and os.path.normpath(entry.path) not in known_dirs:
+            rmtree(entry.path, ignore_errors=True)
+        elif entry.is_file() and entry.name not in known_files:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+    # Track store
+    known_tracks = set(os.path.splitext(os.path.normpath(p))[0] for p in TrackLog.object.values_list('file_path', flat=True))
+    for root, dirs, files in os.walk(tracks_dir):
+        for file in files:
+            file_path = os.path.join(root, file)
+            try:
+                # Converted versions share the stored track's name (only the extension differs)
+                if os.path.splitext(os.path.normpath(file_path))[0] not in known_tracks and os.path.getmtime(file_path) < older_than:
+                    os.remove(file_path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,92 @@
+""" Downloads a single audio stream over several connections at once (byte ranges) """
+from concurrent.futures import ThreadPoolExecutor
+from requests import Session
+from requests.exceptions import RequestException
+import os
+
+
+# Number of connections used to download one stream
+STREAM_CONNECTIONS = 4
+
+# Size (bytes) of each requested byte range
+RANGE_SIZE = 2 * 1024 * 1024
+
+# Streams smaller than this (bytes) are downloaded over a single connection
+MIN_RANGED_SIZE = 4 * 1024 * 1024
+
+RANGE_RETRIES = 3
+RANGE_TIMEOUT = 30  # seconds
+
+HEADERS = {'User-Agent': 'Mozilla/5.0', 'accept-language': 'en-US,en'}
+
+session = Session()
+
+
+def split_ranges(filesize, range_size=RANGE_SIZE):
+    """
+    Returns (start, end) byte ranges (end included) covering filesize(param) bytes
+    """
+    return [(start, min(start + range_size, filesize) - 1) for start in range(0, filesize, range_size)]
+
+
+def fetch_range(url, file_path, start, end):
+    """
+    Downloads the bytes start-end(params) of url into the same position of file_path (retries on errors)
+    and returns the number of bytes written
+    """
+    for attempt in range(RANGE_RETRIES):
+        try:
+            # googlevideo urls take the byte range as a query parameter (like pytubefix does)
+            response = session.get(f'{url}&range={start}-{end}', headers=HEADERS, timeout=RANGE_TIMEOUT)
+            response.raise_for_status()
+            if len(response.content) != end - start + 1:
+                raise RequestException(f'Got {len(response.content)} bytes for range {start}-{end}')
+        except RequestException:
+            if attempt == RANGE_RETRIES - 1:
+                raise
+            continue
+
+        with open(file_path, 'r+b') as f:
+            f.seek(start)
+            return f.write(response.content)
+
+
+def download_stream(stream, output_path, filename, connections=STREAM_CONNECTIONS):
+    """
+    Downloads a pytubefix Stream into output_path/filename using several connections at once
+    (falls back to stream.download() for small streams or if the ranged download fails)
+    ...
+    Parameters :
+    - stream      : pytubefix Stream (usually from yt.streams.get_audio_only())
+    - output_path : directory to download into
+    - filename    : name of the downloaded file
+    - connections : number of connections used at the same time
+    Returns the path of the downloaded file
+    """
+    file_path = os.path.join(output_path, filename)
+    filesize = stream.filesize
+
+    if connections > 1 and filesize >= MIN_RANGED_SIZE:
+        # Preallocate the file - every range is written at its own position
+        with open(file_path, 'wb') as f:
+            f.truncate(filesize)
+
+        written = 0
+        try:
+            with ThreadPoolExecutor(max_workers=connections) as executor:
+                futures = [executor.submit(fetch_range, stream.url, file_path, start, end)
+                           for start, end in split_ranges(filesize)]
+                for future in futures:
+                    written += future.result()
+        except RequestException as e:
+            print(f'Ranged download failed, using a single connection : {e}')
+        else:
+            # The file already has its full size (preallocated) - only the written bytes tell if every range arrived
+            if written == filesize:
+                return file_path
+            print(f'Ranged download got {written} of {filesize} bytes, using a single connection')
+
+        # Never hand back the partly written file
+        os.remove(file_path)
+
+    return stream.download(output_path=output_path, filename=filename, skip_existing=False)
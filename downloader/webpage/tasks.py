@@ -1,41 +1,250 @@
 from celery import shared_task
-from pytubefix import YouTube, Search
+from pytubefix import YouTube
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import F
+from datetime import datetime, timedelta
+import os
 
+from .models import DownloadJob, DownloadItem, VideoLog
+from .track_store import fetch_track, link_track, get_cached_track
+from .resolver import get_youtube_id
+from .audio import convert_track, audio_ext
+from .archive import build_archive
+from . import storage
 
-@shared_task
-def download_batch(batch, batch_id, dir_path):
+
+# Priority of finish_download (0 - 10) - a finished job shouldn't wait behind other jobs' songs
+FINISH_PRIORITY = 9
+
+# Playlist/album songs go through two stages on separate queues (see CELERY_TASK_ROUTES in settings.py) :
+# resolve_item (youtube search - latency bound, many at a time) -> download_track (bandwidth bound, few at a time)
+# The resolved video id is handed over through the DownloadItem row.
+# A job is finished by whichever song completes it (see finish_item) - not by a chord, whose callback
+# depends on every task result still being stored.
+
+
+def finish_item(item, **fields):
+    """
+    Updates a pending DownloadItem with fields(param - status, error ...) and counts it in its job
+    (once - even if a task runs again). Queues finish_download when it was the job's last item.
+    """
+    with transaction.atomic():
+        if not DownloadItem.object.filter(pk=item.pk, status='pending').update(**fields):
+            return
+        DownloadJob.object.filter(pk=item.job_id).update(
+            done_count=F('done_count') + 1,
+            failed_count=F('failed_count') + (1 if fields['status'] == 'failed' else 0),
+            updated_at=datetime.now().replace(tzinfo=None)
+        )
+
+    finish_when_done(item.job_id)
+
+
+def finish_when_done(job_pk):
     """
-    Downloads a batch of songs(usually 10) into the given dir_path using celery's @shared_task
+    Queues finish_download if every item of the job(DownloadJob pk param) is processed
+    (once - only one caller gets to move the job from 'pending' to 'finishing')
+    """
+    if DownloadJob.object.filter(pk=job_pk, status='pending', done_count__gte=F('total')).update(status='finishing'):
+        job_id = DownloadJob.object.filter(pk=job_pk).values_list('job_id', flat=True).first()
+        finish_download.apply_async((job_id,), priority=FINISH_PRIORITY)
+
+
+def fail_item(item, error):
+    """
+    Marks a pending DownloadItem as failed and counts it in its job (see finish_item)
+    """
+    finish_item(item, status='failed', error=str(error)[:300])
+
+
+@shared_task(acks_late=True)
+def resolve_item(item_id):
+    """
+    Resolve stage - finds the youtube video of a song(DownloadItem) and stores its id on the item
+    (tracks already in the track store and cached searches need no youtube search)
     ...
     Parameters :
-    - batch     : Contains a list(batch - 10 default) of audio track's names
-    - batch_id  : An unique id (15 digits) to denote a batch
-    - dir_path  : absolute path to the directory into which all the batch's songs will be downloaded
+    - item_id : id of the DownloadItem of the song
     Return :
-    - batch_id : returns the batch id -> which will be saved in the django_celery_tasks_taskresult table for later use.
+    - item_id : passed on to download_track
     """
-    for song in batch:
-        yt_url = get_youtube_url(song)
-        yt = YouTube(yt_url, 'WEB')
-        audio_stream = yt.streams.get_audio_only()
-        if audio_stream:
-            audio_stream.download(filename=f'{song}.mp3', output_path=dir_path)
+    item = DownloadItem.object.filter(pk=item_id).first()
+    if item is None or item.status != 'pending' or item.youtube_id:
+        # Job deleted, item already processed or resolved (redelivered task)
+        return item_id
+    DownloadItem.object.filter(pk=item.pk).update(started_at=datetime.now().replace(tzinfo=None))
 
-    return batch_id
+    try:
+        track = get_cached_track(spotify_id=item.spotify_id) if item.spotify_id else None
+        youtube_id = track.youtube_id if track else get_youtube_id(item.song_name, item.duration)
+    except Exception as e:
+        print(f'Unable to resolve {item.song_name} : {e}')
+        fail_item(item, e)
+        return item_id
 
-def get_youtube_url(search_query):
+    if youtube_id is None:
+        fail_item(item, 'No youtube results')
+    else:
+        # Waits in the download queue from here on (not started - see fail_stuck_items)
+        DownloadItem.object.filter(pk=item.pk).update(youtube_id=youtube_id, started_at=None)
+
+    return item_id
+
+
+@shared_task(acks_late=True)
+def download_track(item_id, audio_format='original'):
     """
-    Returns the first result's watch URL from youtube when searched using
-    search_query(param) using pytube.Search()
+    Download stage - downloads a resolved song(DownloadItem) into its job's directory
+    (every song is its own task so that idle workers pick up the remaining songs of a job)
+    ...
+    Parameters :
+    - item_id      : id of the DownloadItem of the song (returned by resolve_item)
+    - audio_format : 'original' or one of audio.AUDIO_FORMATS
+    Return :
+    - item_id : returns the item id -> which will be saved in the django_celery_tasks_taskresult table for later use.
     """
+    from .helpers import fix_filename
+
+    item = DownloadItem.object.select_related('job__log').filter(pk=item_id).first()
+    if item is None or item.status != 'pending':
+        # Job deleted, resolving failed or item already processed (redelivered task)
+        return item_id
+    DownloadItem.object.filter(pk=item.pk).update(started_at=datetime.now().replace(tzinfo=None))
+
+    result = {'status': 'failed', 'error': 'No audio stream found'}
     try:
-        searches = Search(search_query + 'official audio')
-        _ = searches.videos[0]
-    except IndexError:
-        searches = Search(search_query)
-        search_vid = searches.videos[0]
-    else:
-        searches = Search(search_query + 'official audio')
-        search_vid = searches.videos[0]
+        # Only the tracks missing from the track store are downloaded
+        yt = YouTube(f'https://youtube.com/watch?v={item.youtube_id}', 'WEB') if item.youtube_id else None
+        track = fetch_track(item.song_name, spotify_id=item.spotify_id, yt=yt, duration=item.duration)
+        if track:
+            file_path = convert_track(track, audio_format)
+            # Song names may contain path separators (example : AC/DC)
+            file_name = f'{fix_filename(item.song_name) or track.youtube_id}.{audio_ext(file_path)}'
+            link_track(track, os.path.join(item.job.log.file_path, file_name), item.job.log, file_path=file_path)
+            result = {'status': 'done', 'file_name': file_name, 'track': track, 'error': None}
+    except Exception as e:
+        # Failed songs are listed in the job's readme.txt (see finish_download)
+        print(f'Unable to download {item.song_name} : {e}')
+        result = {'status': 'failed', 'error': str(e)[:300]}
+
+    # Counted once even if the task runs again
+    finish_item(item, **result)
+
+    return item_id
+
+
+@shared_task
+def finish_download(job_id):
+    """
+    Runs once every song of a job is processed (queued by finish_when_done).
+    Lists the songs that could not be downloaded, builds the job's archive (served by views.job_download,
+    its size counts in the disk budget) and marks the job as ready (or failed if that isn't possible).
+    ...
+    Parameters :
+    - job_id : job_id of the DownloadJob
+    """
+    from .helpers import write_unavailable_songs
+
+    job = DownloadJob.object.select_related('log').filter(job_id=job_id, status='finishing').first()
+    if job is None:
+        # Job deleted or already finished (queued again by fail_stuck_items)
+        return job_id
 
-    return search_vid.watch_url
+    try:
+        failed = job.items.exclude(status='done').order_by('position').values_list('song_name', flat=True)
+        write_unavailable_songs(list(failed), job.log.file_path)
+        zip_path = build_archive(job.log.file_path)
+        VideoLog.object.filter(pk=job.log.pk).update(size=os.path.getsize(zip_path))
+    except Exception as e:
+        print(f'Unable to finish job {job_id} : {e}')
+        DownloadJob.object.filter(pk=job.pk, status='finishing').update(status='failed')
+        return job_id
+
+    DownloadJob.object.filter(pk=job.pk, status='finishing').update(status='ready')
+
+    return job_id
+
+
+@shared_task
+def resolve_tracks(resolve_key, queries):
+    """
+    Speculatively resolves the youtube search results of a listed playlist/album (low priority)
+    so that its download finds them in the search cache. Stops as soon as resolve_key(param)
+    is removed from the cache (see helpers.cancel_resolution).
+    Searches are counted in their own (smaller) 'prefetch' rate limit bucket so that a listed playlist
+    never uses up the search budget of actual downloads.
+    ...
+    Parameters :
+    - resolve_key : cache key marking the resolution as wanted
+    - queries     : list of [search_query, duration] to resolve
+    """
+    cache = caches['spotify']
+    for search_query, duration in queries:
+        if cache.get(resolve_key) is None:
+            print(f'Resolution cancelled : {resolve_key}')
+            return
+        try:
+            get_youtube_id(search_query, duration, bucket='prefetch')
+        except Exception as e:
+            print(f'Unable to resolve {search_query} : {e}')
+
+    cache.delete(resolve_key)
+
+
+# Maintenance tasks - scheduled (once per interval for the whole deployment) by celery beat,
+# see CELERY_BEAT_SCHEDULE in settings.py. Every one of them is safe to run more than once.
+
+@shared_task
+def clear_expired_files():
+    """
+    Deletes the expired files/directories and unused tracks, then the least recently used
+    ones while the track store is over its disk budget (settings.FILES_DISK_BUDGET).
+    """
+    storage.clear_expired_logs()
+    storage.clear_unused_tracks()
+    storage.enforce_disk_budget()
+
+
+@shared_task
+def fail_stuck_items():
+    """
+    Fails the playlist/album songs whose resolve/download task started more than settings.DOWNLOAD_ITEM_TIMEOUT
+    minutes ago and never finished (crashed or lost task) so that their job still finishes.
+    Songs waiting in a queue are never failed - a long queue doesn't mean a job is stuck.
+    Jobs stuck in 'finishing' for as long get their finish_download queued again.
+    """
+    older_than = datetime.now().replace(tzinfo=None) - timedelta(minutes=settings.DOWNLOAD_ITEM_TIMEOUT)
+    for item in DownloadItem.object.filter(status='pending', started_at__lt=older_than):
+        print(f'{item.song_name} timed out')
+        fail_item(item, 'Timed out')
+
+    for job_id in DownloadJob.object.filter(status='finishing', updated_at__lt=older_than).values_list('job_id', flat=True):
+        finish_download.apply_async((job_id,), priority=FINISH_PRIORITY)
+
+
+@shared_task
+def sweep_orphan_files():
+    """
+    Deletes the files/directories that are not logged in the db (see storage.sweep_orphans)
+    """
+    storage.sweep_orphans()
+
+
+@shared_task
+def clear_django_celery_task_results():
+    """
+    Clears up all the saved task results from django-celery-db TaskResult table.
+    """
+    from django_celery_results.models import TaskResult
+    TaskResult.objects.delete_expired(timedelta(minutes=15))
+
+
+@shared_task
+def clear_search_cache():
+    """
+    Deletes expired/least recently used youtube search results from SearchLog table.
+    """
+    from .resolver import clear_search_cache
+    clear_search_cache()
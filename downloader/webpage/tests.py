@@ -1 +1,459 @@
-from django.test import TestCase
+from django.test import SimpleTestCase, TestCase, RequestFactory, override_settings
+from django.utils.http import http_date
+from datetime import datetime, timedelta
+from unittest import mock
+import tempfile
+import zipfile
+import shutil
+import io
+import os
+
+from .models import VideoLog, TrackLog, DownloadJob, DownloadItem, RateBucket, KeyLog, parse_file_metadata
+from .helpers import format_file_id
+from .resolver import get_candidates, score_candidate, search_youtube, parse_length
+from .serving import parse_range, file_response
+from .stream_download import split_ranges
+from .archive import stream_zip
+from .track_store import get_cached_track, link_track, release_tracks
+from . import track_store, storage, rate_limit
+from .spotify_token import TokenHolder, TOKEN_EXPIRES_IN, TOKEN_REFRESH_MARGIN
+from .tasks import FINISH_PRIORITY, finish_item, fail_item, finish_when_done
+
+
+def video_renderer(video_id, title, channel, length):
+    """
+    Returns a search result item in the layout of youtube's search response (see resolver.get_candidates)
+    """
+    return {'videoRenderer': {
+        'videoId': video_id,
+        'title': {'runs': [{'text': title}]},
+        'ownerText': {'runs': [{'text': channel}]},
+        'lengthText': {'simpleText': length},
+    }}
+
+
+class FakeSearch:
+    """
+    Stand-in for pytubefix.Search() holding a search response
+    """
+    def __init__(self, items, videos=()):
+        self.videos = list(videos)
+        self._initial_results = {'contents': {'twoColumnSearchResultsRenderer': {'primaryContents': {
+            'sectionListRenderer': {'contents': [{'itemSectionRenderer': {'contents': items}}]}
+        }}}}
+
+
+class ResolverTests(SimpleTestCase):
+    query = 'Bohemian Rhapsody - Queen'
+    items = [
+        video_renderer('live0000000', 'Queen - Bohemian Rhapsody (Live Aid 1985)', 'Queen Official', '6:02'),
+        video_renderer('loop0000000', 'Bohemian Rhapsody 1 hour loop', 'Loops', '1:00:00'),
+        {'shelfRenderer': {}},
+        video_renderer('topic000000', 'Bohemian Rhapsody', 'Queen - Topic', '5:55'),
+    ]
+
+    def test_parse_length(self):
+        self.assertEqual(parse_length('1:02:03'), 3723)
+        self.assertEqual(parse_length('3:05'), 185)
+        self.assertIsNone(parse_length(None))
+        self.assertIsNone(parse_length('LIVE'))
+
+    def test_get_candidates(self):
+        candidates = get_candidates(FakeSearch(self.items))
+        self.assertEqual([c['video_id'] for c in candidates], ['live0000000', 'loop0000000', 'topic000000'])
+        self.assertEqual(candidates[2], {'video_id': 'topic000000', 'title': 'Bohemian Rhapsody',
+                                         'channel': 'Queen - Topic', 'length': 355})
+
+    def test_get_candidates_unknown_layout(self):
+        search = FakeSearch([], videos=[mock.Mock(video_id='abcdefghijk')])
+        search._initial_results = {}
+        self.assertEqual(get_candidates(search), [{'video_id': 'abcdefghijk', 'title': '', 'channel': '', 'length': None}])
+
+    def test_score_prefers_studio_track(self):
+        live, loop, topic = get_candidates(FakeSearch(self.items))
+        self.assertGreater(score_candidate(topic, self.query, 355), score_candidate(live, self.query, 355))
+        self.assertGreater(score_candidate(topic, self.query, 355), score_candidate(loop, self.query, 355))
+
+    def test_score_keeps_asked_version(self):
+        live, _, topic = get_candidates(FakeSearch(self.items))
+        query = 'Bohemian Rhapsody (Live Aid) - Queen'
+        self.assertGreater(score_candidate(live, query, 362), score_candidate(topic, query, 362))
+
+    def test_score_without_duration(self):
+        _, loop, topic = get_candidates(FakeSearch(self.items))
+        self.assertGreater(score_candidate(topic, self.query), score_candidate(loop, self.query))
+
+    @mock.patch('webpage.resolver.acquire')
+    def test_search_youtube(self, acquire):
+        with mock.patch('webpage.resolver.Search', return_value=FakeSearch(self.items)):
+            self.assertEqual(search_youtube(self.query, 355), 'topic000000')
+        acquire.assert_called_once_with('search')
+
+    @mock.patch('webpage.resolver.acquire')
+    def test_search_youtube_falls_back_to_top_result(self, acquire):
+        items = [video_renderer('other000000', 'Something else', 'Someone', '2:00'),
+                 video_renderer('other111111', 'Another song', 'Somebody', '9:00')]
+        with mock.patch('webpage.resolver.Search', return_value=FakeSearch(items)):
+            self.assertEqual(search_youtube(self.query, 355, bucket='prefetch'), 'other000000')
+        acquire.assert_called_once_with('prefetch')
+
+    @mock.patch('webpage.resolver.acquire')
+    def test_search_youtube_no_results(self, acquire):
+        with mock.patch('webpage.resolver.Search', return_value=FakeSearch([])):
+            self.assertIsNone(search_youtube(self.query, 355))
+
+
+class FileMetadataTests(SimpleTestCase):
+    def test_parse_file_metadata(self):
+        self.assertEqual(parse_file_metadata('sp_album__123532'), ('sp', 'album', '123532'))
+        self.assertEqual(parse_file_metadata('sp_playlist_mp3__37i9dQ'), ('sp', 'playlist_mp3', '37i9dQ'))
+        self.assertEqual(parse_file_metadata('yt_audio'), ('yt', 'audio', None))
+
+    def test_format_file_id(self):
+        self.assertEqual(format_file_id('sp_album__123532'), 'sp_album__123532')
+        self.assertEqual(format_file_id('sp_album__123532', 'mp3'), 'sp_album_mp3__123532')
+        self.assertEqual(format_file_id('yt_audio', 'opus'), 'yt_audio_opus')
+        self.assertEqual(parse_file_metadata(format_file_id('sp_track__9x', 'm4a')), ('sp', 'track_m4a', '9x'))
+
+
+@override_settings(FILE_OFFLOAD=None)
+class ServingTests(SimpleTestCase):
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir_path)
+        self.file_path = os.path.join(self.dir_path, 'song.m4a')
+        self.data = bytes(range(256)) * 40
+        with open(self.file_path, 'wb') as f:
+            f.write(self.data)
+        self.factory = RequestFactory()
+
+    def get(self, **headers):
+        response = file_response(self.factory.get('/file', headers=headers), self.file_path, 'song.m4a')
+        self.addCleanup(response.close)
+        return response
+
+    def test_parse_range(self):
+        self.assertEqual(parse_range('bytes=0-99', 1000), (0, 99))
+        self.assertEqual(parse_range('bytes=500-', 1000), (500, 999))
+        self.assertEqual(parse_range('bytes=-100', 1000), (900, 999))
+        self.assertEqual(parse_range('bytes=-5000', 1000), (0, 999))
+        self.assertEqual(parse_range('bytes=900-5000', 1000), (900, 999))
+        self.assertIsNone(parse_range(None, 1000))
+        self.assertIsNone(parse_range('bytes=0-1,5-9', 1000))
+        self.assertEqual(parse_range('bytes=1000-', 1000), 'invalid')
+        self.assertEqual(parse_range('bytes=50-10', 1000), 'invalid')
+        self.assertEqual(parse_range('bytes=-0', 1000), 'invalid')
+        self.assertEqual(parse_range('bytes=-', 1000), 'invalid')
+
+    def test_whole_file(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Length'], str(len(self.data)))
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(b''.join(response.streaming_content), self.data)
+
+    def test_partial_content(self):
+        response = self.get(Range='bytes=100-299')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 100-299/{len(self.data)}')
+        self.assertEqual(response['Content-Length'], '200')
+        self.assertEqual(b''.join(response.streaming_content), self.data[100:300])
+
+    def test_range_not_satisfiable(self):
+        response = self.get(Range=f'bytes={len(self.data)}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(self.data)}')
+
+    def test_if_range(self):
+        etag = self.get()['ETag']
+        self.assertEqual(self.get(Range='bytes=0-9', **{'If-Range': etag}).status_code, 206)
+        # Changed file - the whole file is sent again
+        self.assertEqual(self.get(Range='bytes=0-9', **{'If-Range': '"stale"'}).status_code, 200)
+
+    def test_not_modified(self):
+        response = self.get()
+        self.assertEqual(self.get(**{'If-None-Match': response['ETag']}).status_code, 304)
+        self.assertEqual(self.get(**{'If-Modified-Since': response['Last-Modified']}).status_code, 304)
+        self.assertEqual(self.get(**{'If-Modified-Since': http_date(0)}).status_code, 200)
+
+
+class StreamDownloadTests(SimpleTestCase):
+    def test_split_ranges(self):
+        self.assertEqual(split_ranges(10, 4), [(0, 3), (4, 7), (8, 9)])
+        self.assertEqual(split_ranges(8, 4), [(0, 3), (4, 7)])
+        self.assertEqual(split_ranges(3, 4), [(0, 2)])
+        self.assertEqual(split_ranges(0, 4), [])
+
+    def test_split_ranges_cover_file(self):
+        ranges = split_ranges(10 * 1024 * 1024 + 7)
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], 10 * 1024 * 1024 + 6)
+        for (_, end), (start, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(start, end + 1)
+
+
+class ArchiveTests(SimpleTestCase):
+    def test_stream_zip_round_trip(self):
+        dir_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dir_path)
+        contents = {'a.m4a': os.urandom(3 * 1024 * 1024 + 11), 'b.mp3': b'', 'AC DC - Thunderstruck.opus': b'x' * 100}
+        files = []
+        for name, data in contents.items():
+            file_path = os.path.join(dir_path, name)
+            with open(file_path, 'wb') as f:
+                f.write(data)
+            files.append((file_path, name))
+
+        for compression in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            chunks = list(stream_zip(files, compression))
+            self.assertGreater(len(chunks), 1)
+            with zipfile.ZipFile(io.BytesIO(b''.join(chunks))) as zip_file:
+                self.assertIsNone(zip_file.testzip())
+                self.assertEqual(zip_file.namelist(), list(contents))
+                for name, data in contents.items():
+                    self.assertEqual(zip_file.read(name), data)
+
+
+@mock.patch('webpage.tasks.finish_download.apply_async')
+class JobCompletionTests(TestCase):
+    def setUp(self):
+        log = VideoLog.object.create(file_path='/tmp/job', file_type='directory', file_metadata='sp_playlist__37i9dQ')
+        self.job = DownloadJob.object.create(job_id='job1', log=log, total=2, updated_at=datetime.now())
+        self.items = [DownloadItem.object.create(job=self.job, position=i, song_name=f'Song {i}') for i in (1, 2)]
+
+    def test_item_counted_once(self, apply_async):
+        finish_item(self.items[0], status='done', file_name='Song 1.m4a')
+        # Redelivered task
+        finish_item(self.items[0], status='failed', error='late failure')
+        self.job.refresh_from_db()
+        self.assertEqual((self.job.done_count, self.job.failed_count), (1, 0))
+        self.assertEqual(DownloadItem.object.get(pk=self.items[0].pk).status, 'done')
+        apply_async.assert_not_called()
+
+    def test_failed_item(self, apply_async):
+        fail_item(self.items[1], 'No youtube results')
+        self.job.refresh_from_db()
+        self.assertEqual((self.job.done_count, self.job.failed_count), (1, 1))
+        self.assertEqual(DownloadItem.object.get(pk=self.items[1].pk).error, 'No youtube results')
+
+    def test_last_item_finishes_job_once(self, apply_async):
+        finish_item(self.items[0], status='done')
+        fail_item(self.items[1], 'No audio stream found')
+        self.assertEqual(DownloadJob.object.get(pk=self.job.pk).status, 'finishing')
+        apply_async.assert_called_once_with(('job1',), priority=FINISH_PRIORITY)
+
+        # Racing callers (or a job created with every song already done) never queue it again
+        finish_when_done(self.job.pk)
+        finish_item(self.items[1], status='done')
+        apply_async.assert_called_once()
+
+    def test_empty_job_finishes(self, apply_async):
+        self.job.items.all().delete()
+        DownloadJob.object.filter(pk=self.job.pk).update(total=0)
+        finish_when_done(self.job.pk)
+        apply_async.assert_called_once_with(('job1',), priority=FINISH_PRIORITY)
+
+
+class TrackStoreTests(TestCase):
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir_path)
+        self.file_path = os.path.join(self.dir_path, 'dQw4w9WgXcQ.m4a')
+        with open(self.file_path, 'wb') as f:
+            f.write(b'audio' * 100)
+        self.track = TrackLog.object.create(youtube_id='dQw4w9WgXcQ', spotify_id='4uLU6hMC', file_path=self.file_path, size=500)
+
+    def make_log(self, name):
+        return VideoLog.object.create(file_path=self.dir_path, file_name=name, file_metadata='sp_track__4uLU6hMC')
+
+    def ref_count(self):
+        return TrackLog.object.get(pk=self.track.pk).ref_count
+
+    def test_link_track(self):
+        log = self.make_log('Never Gonna Give You Up.m4a')
+        dest_path = os.path.join(self.dir_path, log.file_name)
+        link_track(self.track, dest_path, log)
+        # Redelivered task - the log keeps a single reference
+        link_track(self.track, dest_path, log)
+        self.assertTrue(os.path.samefile(dest_path, self.file_path))
+        self.assertEqual(self.ref_count(), 1)
+
+    def test_release_tracks(self):
+        logs = [self.make_log('a.m4a'), self.make_log('b.m4a')]
+        for log in logs:
+            link_track(self.track, os.path.join(self.dir_path, log.file_name), log)
+        self.assertEqual(self.ref_count(), 2)
+
+        release_tracks(logs[0])
+        release_tracks(logs[0])
+        self.assertEqual(self.ref_count(), 1)
+        self.assertFalse(logs[0].tracks.exists())
+        self.assertTrue(logs[1].tracks.filter(pk=self.track.pk).exists())
+
+    def test_get_cached_track(self):
+        self.assertEqual(get_cached_track(spotify_id='4uLU6hMC'), self.track)
+        self.assertEqual(get_cached_track(youtube_id='dQw4w9WgXcQ'), self.track)
+        self.assertIsNone(get_cached_track(spotify_id='unknown'))
+
+    def test_get_cached_track_missing_file(self):
+        os.remove(self.file_path)
+        self.assertIsNone(get_cached_track(youtube_id='dQw4w9WgXcQ'))
+        self.assertFalse(TrackLog.object.filter(pk=self.track.pk).exists())
+
+
+class StorageTests(TestCase):
+    def setUp(self):
+        self.files_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.files_dir)
+        tracks_dir = os.path.join(self.files_dir, 'tracks')
+        os.makedirs(tracks_dir)
+        for name, value in (('FILES_DIR', self.files_dir), ('TRACKS_DIR', tracks_dir)):
+            patcher = mock.patch.object(track_store, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def write_file(self, file_path, size=100, age=0):
+        """
+        Writes a file of size(param) bytes last modified age(param) minutes ago
+        """
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'wb') as f:
+            f.write(b'x' * size)
+        mtime = (datetime.now() - timedelta(minutes=age)).timestamp()
+        os.utime(file_path, (mtime, mtime))
+        return file_path
+
+    def make_track(self, youtube_id, unused_for):
+        """
+        Stores a track last used unused_for(param) minutes ago
+        """
+        file_path = self.write_file(track_store.track_path(youtube_id))
+        return TrackLog.object.create(youtube_id=youtube_id, file_path=file_path, size=100,
+                                      last_used_at=datetime.now() - timedelta(minutes=unused_for))
+
+    def make_job(self, name, status, tracks):
+        dir_path = os.path.join(self.files_dir, name)
+        os.makedirs(dir_path)
+        log = VideoLog.object.create(file_path=dir_path, file_type='directory', file_metadata='sp_playlist__37i9dQ',
+                                     expires_at=datetime.now() + timedelta(minutes=30))
+        DownloadJob.object.create(job_id=name, log=log, status=status, total=len(tracks))
+        for track in tracks:
+            track_store.link_track(track, os.path.join(dir_path, f'{track.youtube_id}.m4a'), log)
+        return log
+
+    def test_eviction_keeps_recent_tracks(self):
+        old = self.make_track('old00000000', unused_for=storage.TRACK_GRACE_PERIOD + 5)
+        fresh = self.make_track('fresh000000', unused_for=1)
+        storage.enforce_disk_budget(0)
+        self.assertEqual(list(TrackLog.object.values_list('youtube_id', flat=True)), ['fresh000000'])
+        self.assertFalse(os.path.exists(old.file_path))
+        self.assertTrue(os.path.exists(fresh.file_path))
+
+    def test_eviction_of_ready_jobs(self):
+        ready = self.make_job('ready', 'ready', [self.make_track('ready000000', unused_for=1)])
+        pending = self.make_job('pending', 'pending', [self.make_track('pending0000', unused_for=1)])
+        storage.enforce_disk_budget(150)
+        # The ready job goes with the track only it used, the job in progress is never touched
+        self.assertFalse(VideoLog.object.filter(pk=ready.pk).exists())
+        self.assertFalse(os.path.exists(ready.file_path))
+        self.assertEqual(list(TrackLog.object.values_list('youtube_id', flat=True)), ['pending0000'])
+        self.assertEqual(VideoLog.object.get(pk=pending.pk).tracks.count(), 1)
+
+    def test_sweep_orphans(self):
+        track = self.make_track('known000000', unused_for=0)
+        converted = self.write_file(os.path.splitext(track.file_path)[0] + '.mp3', age=120)
+        orphan_track = self.write_file(track_store.track_path('orphan00000'), age=120)
+        VideoLog.object.create(file_path=self.files_dir, file_name='known.m4a')
+        known = self.write_file(os.path.join(self.files_dir, 'known.m4a'), age=120)
+        orphan = self.write_file(os.path.join(self.files_dir, 'orphan.m4a'), age=120)
+        in_progress = self.write_file(os.path.join(self.files_dir, 'orphan.part'))
+
+        storage.sweep_orphans()
+        for file_path in (track.file_path, converted, known, in_progress):
+            self.assertTrue(os.path.exists(file_path), file_path)
+        for file_path in (orphan_track, orphan):
+            self.assertFalse(os.path.exists(file_path), file_path)
+
+
+@mock.patch('webpage.rate_limit.time', return_value=1000.0)
+class RateLimitTests(TestCase):
+    limits = {'search': {'rate': 2, 'burst': 2}, 'spotify': {'rate': 0, 'burst': 20}}
+
+    def setUp(self):
+        rate_limit.local_buckets.clear()
+        self.addCleanup(rate_limit.local_buckets.clear)
+
+    def test_db_bucket(self, time):
+        self.assertEqual([rate_limit.try_acquire_db('search', 2, 2) for _ in range(3)], [0, 0, 0.5])
+        time.return_value = 1000.25
+        self.assertEqual(rate_limit.try_acquire_db('search', 2, 2), 0.25)
+        time.return_value = 1001.0
+        self.assertEqual(rate_limit.try_acquire_db('search', 2, 2), 0)
+
+        bucket = RateBucket.object.get(name='search')
+        self.assertEqual((bucket.acquired, bucket.throttled, bucket.wait_seconds), (3, 2, 0.75))
+
+    def test_local_bucket(self, time):
+        bucket = rate_limit.LocalBucket()
+        self.assertEqual([bucket.try_acquire(2, 2) for _ in range(3)], [0, 0, 0.5])
+        time.return_value = 1000.5
+        self.assertEqual(bucket.try_acquire(2, 2), 0)
+        self.assertEqual((bucket.acquired, bucket.throttled), (3, 1))
+
+    @override_settings(RATE_LIMIT_BACKEND='db', RATE_LIMITS=limits)
+    def test_shared_backend(self, time):
+        self.assertEqual([rate_limit.try_acquire('search') for _ in range(3)], [0, 0, 0.5])
+        self.assertEqual(RateBucket.object.get(name='search').acquired, 2)
+        self.assertEqual(rate_limit.get_metrics()['search']['shared'], True)
+
+    @override_settings(RATE_LIMIT_BACKEND='local', RATE_LIMITS=limits)
+    def test_local_backend(self, time):
+        self.assertEqual([rate_limit.try_acquire('search') for _ in range(3)], [0, 0, 0.5])
+        self.assertFalse(RateBucket.object.exists())
+        self.assertEqual(rate_limit.get_metrics()['search'], {'acquired': 2, 'throttled': 1, 'wait_seconds': 0.5, 'shared': False})
+
+    @override_settings(RATE_LIMIT_BACKEND='db', RATE_LIMITS=limits)
+    def test_unlimited(self, time):
+        # Rate 0 and buckets missing from RATE_LIMITS never wait
+        self.assertEqual([rate_limit.try_acquire('spotify') for _ in range(30)], [0] * 30)
+        self.assertEqual(rate_limit.try_acquire('stream'), 0)
+        self.assertFalse(RateBucket.object.exists())
+
+
+@mock.patch.object(TokenHolder, 'schedule_refresh')
+@mock.patch('webpage.spotify_token.get_token', return_value='new-token')
+class TokenHolderTests(TestCase):
+    def add_key(self, token, expires_in):
+        return KeyLog.object.create(api_token=token, expires_at=datetime.now() + timedelta(seconds=expires_in))
+
+    def test_new_token(self, get_token, schedule_refresh):
+        holder = TokenHolder()
+        self.assertEqual(holder.get(), 'new-token')
+        self.assertEqual(holder.get(), 'new-token')
+        get_token.assert_called_once()
+        # Shared with the other processes
+        self.assertEqual(KeyLog.object.get().api_token, 'new-token')
+        schedule_refresh.assert_called_once()
+
+    def test_shared_token(self, get_token, schedule_refresh):
+        self.add_key('shared-token', TOKEN_EXPIRES_IN - 60)
+        self.assertEqual(TokenHolder().get(), 'shared-token')
+        get_token.assert_not_called()
+
+    def test_expiring_shared_token(self, get_token, schedule_refresh):
+        self.add_key('expired-token', -60)
+        self.add_key('expiring-token', TOKEN_REFRESH_MARGIN - 60)
+        self.assertEqual(TokenHolder().get(), 'new-token')
+        self.assertEqual(sorted(KeyLog.object.values_list('api_token', flat=True)), ['expiring-token', 'new-token'])
+
+    @mock.patch.object(TokenHolder, 'refresh_in_background')
+    def test_refreshed_in_background(self, refresh_in_background, get_token, schedule_refresh):
+        holder = TokenHolder()
+        holder.token, holder.expires_at = 'old-token', datetime.now() + timedelta(seconds=TOKEN_REFRESH_MARGIN - 60)
+        # Still valid - handed out while the refresh runs
+        self.assertEqual(holder.get(), 'old-token')
+        refresh_in_background.assert_called_once()
+        get_token.assert_not_called()
+
+        holder.expires_at = datetime.now() - timedelta(seconds=1)
+        self.assertEqual(holder.get(), 'new-token')
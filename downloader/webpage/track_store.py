@@ -0,0 +1,163 @@
+""" Shared (content-addressed) store of downloaded tracks used by every download job """
+from django.db.models import F
+from pytubefix import YouTube
+from pathlib import Path
+from datetime import datetime, timedelta
+from shutil import copyfile
+from uuid import uuid4
+import hashlib
+import os
+
+from .models import TrackLog
+from .resolver import get_youtube_url
+from .stream_download import download_stream
+from .rate_limit import acquire
+
+
+# Files directory (job directories, single files and the track store) - the only place it is defined,
+# read as track_store.FILES_DIR at call time so that it can be pointed elsewhere (see the benchmark command)
+# Track store : sharded by the hash of the youtube video id
+FILES_DIR = os.path.join(Path(__file__).resolve().parent.parent, '..\\files')
+TRACKS_DIR = os.path.join(FILES_DIR, 'tracks')
+
+# Unreferenced track expiring duration in minutes (refreshed each time a track is used)
+TRACK_EXPIRES_IN = 60 * 24
+
+
+def track_path(youtube_id, ext='m4a'):
+    """
+    Returns the sharded path of a track inside the store
+    (example : <TRACKS_DIR>/3f/a2/dQw4w9WgXcQ.m4a)
+    """
+    digest = hashlib.sha1(youtube_id.encode('utf-8')).hexdigest()
+    return os.path.join(TRACKS_DIR, digest[:2], digest[2:4], f'{youtube_id}.{ext}')
+
+
+def get_cached_track(spotify_id=None, youtube_id=None):
+    """
+    Returns the TrackLog of an already stored track (or None)
+    ...
+    Parameters :
+    - spotify_id : Spotify track id
+    - youtube_id : Youtube video id
+    """
+    track = None
+    if spotify_id:
+        track = TrackLog.object.filter(spotify_id=spotify_id).first()
+    if track is None and youtube_id:
+        track = TrackLog.object.filter(youtube_id=youtube_id).first()
+
+    if track is not None and not os.path.exists(track.file_path):
+        # File went missing from the disk - forget about it so it gets downloaded again
+        track.delete()
+        track = None
+    elif track is not None:
+        # Cache hit - keep the track around for a while longer
+        curr_timestamp = datetime.now().replace(tzinfo=None)
+        TrackLog.object.filter(pk=track.pk).update(
+            last_used_at=curr_timestamp,
+            expires_at=curr_timestamp + timedelta(minutes=TRACK_EXPIRES_IN)
+        )
+
+    return track
+
+
+def store_track(yt, spotify_id=None):
+    """
+    Downloads the audio stream of yt(param) into the track store and returns its TrackLog
+    (None if the video has no audio stream)
+    ...
+    Parameters :
+    - yt         : pytubefix.Youtube() class's object of the track
+    - spotify_id : Spotify track id of the track (if known)
+    """
+    youtube_id = yt.video_id
+    # One token per track - covers the video info request and the audio download
+    acquire('stream')
+    ys = yt.streams.get_audio_only()
+    if not ys:
+        return None
+
+    # Stored in the container youtube sends (audio/mp4 -> .m4a, audio/webm -> .webm)
+    file_path = track_path(youtube_id, 'm4a' if ys.subtype == 'mp4' else ys.subtype)
+
+    # Download under a temporary name so that concurrent workers never see a partial file
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    tmp_name = f'{youtube_id}.{uuid4().hex[:8]}.part'
+    download_stream(ys, os.path.dirname(file_path), tmp_name)
+    os.replace(os.path.join(os.path.dirname(file_path), tmp_name), file_path)
+
+    curr_timestamp = datetime.now().replace(tzinfo=None)
+    track, created = TrackLog.object.get_or_create(
+        youtube_id=youtube_id,
+        defaults={
+            'spotify_id': spotify_id,
+            'file_path': file_path,
+            'size': os.path.getsize(file_path),
+            'last_used_at': curr_timestamp,
+            'expires_at': curr_timestamp + timedelta(minutes=TRACK_EXPIRES_IN)
+        }
+    )
+    if not created and spotify_id and not track.spotify_id:
+        track.spotify_id = spotify_id
+        track.save(update_fields=['spotify_id'])
+
+    return track
+
+
+def fetch_track(search_query, spotify_id=None, yt=None, duration=None):
+    """
+    Returns the TrackLog of the given track - downloads it only if it isn't already stored.
+    ...
+    Parameters :
+    - search_query : Youtube search string of the track (used only on a miss)
+    - spotify_id   : Spotify track id of the track (if known)
+    - yt           : already created pytubefix.Youtube() object (skips the search)
+    - duration     : length of the track in seconds (helps picking the right search result)
+    """
+    track = get_cached_track(spotify_id=spotify_id)
+    if track is not None:
+        return track
+
+    if yt is None:
+        yt = YouTube(get_youtube_url(search_query, duration), 'WEB')
+
+    track = get_cached_track(youtube_id=yt.video_id)
+    if track is not None:
+        if spotify_id and not track.spotify_id:
+            track.spotify_id = spotify_id
+            track.save(update_fields=['spotify_id'])
+        return track
+
+    return store_track(yt, spotify_id=spotify_id)
+
+
+def link_track(track, dest_path, log=None, file_path=None):
+    """
+    Hard links a stored track to dest_path (copies it if linking is not possible)
+    and adds a reference to it from log(VideoLog param).
+    file_path(param) links a converted version of the track instead (see audio.convert_track).
+    """
+    if file_path is None:
+        file_path = track.file_path
+
+    if not os.path.exists(dest_path):
+        try:
+            os.link(file_path, dest_path)
+        except FileExistsError:
+            pass
+        except OSError:
+            # Different file system (or no hard link support)
+            copyfile(file_path, dest_path)
+
+    if log is not None and not log.tracks.filter(pk=track.pk).exists():
+        log.tracks.add(track)
+        TrackLog.object.filter(pk=track.pk).update(ref_count=F('ref_count') + 1)
+
+
+def release_tracks(log):
+    """
+    Drops the references log(VideoLog param) holds on stored tracks (called before the log is deleted)
+    """
+    TrackLog.object.filter(videolog=log).update(ref_count=F('ref_count') - 1)
+    log.tracks.clear()
@@ -7,5 +7,10 @@ urlpatterns = [
     path('spotify/', views.spotify, name='spotify'),
     path('spotify/track', views.spotify_track, name='spotify track'),
     path('spotify/album', views.spotify_album, name='spotify album'),
+    path('job/<str:job_id>/', views.job, name='job'),
+    path('job/<str:job_id>/status', views.job_status, name='job status'),
+    path('job/<str:job_id>/download', views.job_download, name='job download'),
+    path('file/<int:file_id>/', views.file_download, name='file download'),
     path('info/', views.info_page, name='info'),
+    path('metrics/rate-limits/', views.rate_limits, name='rate limits'),
 ]
\ No newline at end of file
@@ -1,22 +1,31 @@
 from django.shortcuts import render, redirect, HttpResponse
 from django.contrib import messages
-from django.http import FileResponse
-from .spotify import (
-    get_playlist_tracks, get_playlist_info, get_track_info,
-    get_album_tracks, get_album_info
-)
+from django.http import JsonResponse
+from . import spotify_async, track_store
 from urllib.parse import urlparse
-from django_celery_results.models import TaskResult
 from .helpers import *
+from .downloader import download_20
+from .serving import file_response, asgi_stream
+from .archive import archive_path
+from .rate_limit import get_metrics as get_rate_limit_metrics
 from uuid import uuid4
-import zipfile
-from time import sleep
-import io
+import asyncio
 import re
 import os
 
 
-def home(request):
+# Maximum time (seconds) a job status request waits for progress
+LONG_POLL_TIMEOUT = 20
+
+# Time (seconds) between two progress checks of a waiting job status request
+LONG_POLL_INTERVAL = 2
+
+# home, youtube and the spotify pages are async views - Spotify is called through an async client
+# and blocking work (pytubefix, downloads, db writes) runs in worker threads (see helpers.run_blocking)
+# so that a process keeps serving other pages while these wait on upstream I/O (deploy with downloader/asgi.py - see README)
+
+
+async def home(request):
     """Home page"""
     # Delete all logs
     # VideoLog.object.all().delete()
@@ -33,14 +42,14 @@ def home(request):
         re_track = r'/track/'
         re_album = r'/album/'
 
-        request.session['link'] = input_link
+        await request.session.aset('link', input_link)
 
         if parsed_url.netloc in netloc_dict['youtube']:
             # redirect to youtube link page
             return redirect('youtube')
 
         elif parsed_url.netloc in netloc_dict['spotify']:
-            request.session['parsed_link'] = parsed_url
+            await request.session.aset('parsed_link', parsed_url)
             if re.match(re_playlist, parsed_url.path):
                 return redirect('spotify')
             elif re.match(re_track, parsed_url.path):
@@ -55,38 +64,35 @@ def home(request):
     return render(request, 'webpage/index.html')
 
 
-def youtube(request):
+async def youtube(request):
     """Youtube audio page"""
-    link = request.session.get('link', '')
-    yt = YouTube(link, 'WEB')
-    duration = calculate_duration(yt.length)
+    link = await request.session.aget('link', '')
+    yt, duration = await run_blocking(load_youtube, link)
 
     if request.method == 'POST':
         filename_input = request.POST['filenameinput']
 
         filename = fix_filename(filename_input)
 
-        file_to_download, filepath = download_song(filename, yt, f_id='yt_audio')
-
-        # Downloading audio to user
-        response = FileResponse(open(os.path.join(filepath, file_to_download), 'rb'),
-                               as_attachment=True, filename=file_to_download)
+        file_log = await run_blocking(download_song, filename, yt, f_id='yt_audio', audio_format=get_audio_format(request))
 
-        return response
+        # Downloading audio to user (from a GET url so that interrupted downloads can resume)
+        return redirect_to_file(request, file_log)
 
     return render(request, 'webpage/youtube.html',
                   {'link': link, 'yt': yt, 'duration': duration})
 
 
-def spotify(request):
+@spotify_async.with_session
+async def spotify(request):
     """Spotify playlist page"""
-    link = request.session.get('link', '')
-    parsed_link = request.session.get('parsed_link', '')
+    link = await request.session.aget('link', '')
+    parsed_link = await request.session.aget('parsed_link', '')
     playlist_id = parsed_link[2].split('/')[-1]
 
-    token = get_spotify_token()
-    playlist_songs = get_playlist_tracks(token, playlist_id)
-    playlist_info = get_playlist_info(token, playlist_id)
+    token = await aget_spotify_token()
+    # Cached - the download POST reuses what the listing GET fetched
+    playlist_songs, playlist_info = await aget_playlist_data(token, playlist_id)
 
     if playlist_songs:
         songs_len = len(playlist_songs)
@@ -96,48 +102,30 @@ def spotify(request):
             print('downloading playlist')
             if songs_len <= 20:
                 try:
-                    return download_20(request, songs_len)
+                    await run_blocking(cancel_resolution, f'sp_playlist__{playlist_id}')
+                    response = await run_blocking(download_20, get_song_inputs(request, playlist_songs), get_audio_format(request))
+                    return asgi_stream(request, response)
                 except Exception as e:
                     return HttpResponse(f'Exception occurred {str(e)}', status=500)
 
             else:
-                # download as chunks to the server
-                song_inputs = []
-                for i in range(1, songs_len + 1):
-                    song = request.POST.get(f'song_name_{i}')
-                    song_inputs.append(song)
-
-                songs_fragments = create_song_batches(song_inputs)
+                # download to the server (one celery task per song)
+                song_inputs = get_song_inputs(request, playlist_songs)
+                await run_blocking(cancel_resolution, f'sp_playlist__{playlist_id}')
 
                 dir_filename = f'{uuid4().hex[:8]}_{datetime.now().strftime("%Y%m%d%H%M%S")}'
-                CWD_PATH = os.path.join(Path(__file__).resolve().parent.parent, '..\\files')
-                dir_path = os.path.join(CWD_PATH, dir_filename)
-
-                r_batch_id, r_dir_path, r_file_name = download_song_fragment(dir_path, songs_fragments, f_id=f'sp_playlist__{playlist_id}')
-
-                if r_batch_id is not None:
-
-                    timeout_mech(songs_fragments, r_batch_id)
-
-                    downloaded_contents = os.listdir(dir_path)
-
-                    if len(song_inputs) != len(downloaded_contents):
-                        write_unavailable_songs(song_inputs, downloaded_contents, dir_path)
-
-                zip_buffer = io.BytesIO()
-                with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-                    for root, dirs, files in os.walk(r_dir_path):
-                        for file in files:
-                            file_path = os.path.join(root, file)
-                            zip_file.write(file_path, os.path.relpath(file_path, r_dir_path))
+                dir_path = os.path.join(track_store.FILES_DIR, dir_filename)
 
-                zip_buffer.seek(0)
+                r_job_id, r_dir_path, r_file_name = await run_blocking(download_song_fragment, dir_path, song_inputs,
+                                                                         f_id=f'sp_playlist__{playlist_id}',
+                                                                         audio_format=get_audio_format(request))
 
-                response = HttpResponse(zip_buffer, 'application/zip')
-                response['Content-Disposition'] = f'attachment; filename={r_file_name}.zip'
+                # Returns right away - the job page follows the progress and hands out the archive
+                return redirect('job', job_id=r_job_id)
 
-                return response
 
+        # Search the songs on youtube in the background while the user looks at the list
+        await run_blocking(start_resolution, f'sp_playlist__{playlist_id}', playlist_songs)
 
         return render(request, 'webpage/spotify.html',
                        {'link': link, 'link_type': 'spotify',
@@ -148,15 +136,16 @@ def spotify(request):
         return redirect('home')
 
 
-def spotify_album(request):
+@spotify_async.with_session
+async def spotify_album(request):
     """Spotify album page"""
-    link = request.session.get('link', '')
-    parsed_link = request.session.get('parsed_link', '')
+    link = await request.session.aget('link', '')
+    parsed_link = await request.session.aget('parsed_link', '')
     album_id = parsed_link[2].split('/')[-1]
 
-    token = get_spotify_token()
-    album_songs = get_album_tracks(token, album_id)
-    album_info = get_album_info(token, album_id)
+    token = await aget_spotify_token()
+    # Cached - the download POST reuses what the listing GET fetched
+    album_songs, album_info = await aget_album_data(token, album_id)
 
     if album_songs:
         songs_len = len(album_songs)
@@ -164,50 +153,32 @@ def spotify_album(request):
         if request.method == "POST":
             if songs_len <= 20:
                 try:
-                    return download_20(request, songs_len)
+                    await run_blocking(cancel_resolution, f'sp_album__{album_id}')
+                    response = await run_blocking(download_20, get_song_inputs(request, album_songs), get_audio_format(request))
+                    return asgi_stream(request, response)
                 except Exception as e:
                     return HttpResponse(f'Exception occurred {str(e)}', status=500)
 
             else:
                 print('in here - album')
-                # download as chunks to the server
+                # download to the server (one celery task per song)
                 print('in here')
-                song_inputs = []
-                for i in range(1, songs_len + 1):
-                    song = request.POST.get(f'song_name_{i}')
-                    song_inputs.append(song)
-
-                songs_fragments = create_song_batches(song_inputs)
+                song_inputs = get_song_inputs(request, album_songs)
+                await run_blocking(cancel_resolution, f'sp_album__{album_id}')
 
                 dir_filename = f'{uuid4().hex[:8]}_{datetime.now().strftime("%Y%m%d%H%M%S")}'
-                CWD_PATH = os.path.join(Path(__file__).resolve().parent.parent, '..\\files')
-                dir_path = os.path.join(CWD_PATH, dir_filename)
-
-                r_batch_id, r_dir_path, r_file_name = download_song_fragment(dir_path, songs_fragments, f_id=f'sp_album__{album_id}')
-
-                if r_batch_id is not None:
-
-                    timeout_mech(songs_fragments, r_batch_id)
-
-                    downloaded_contents = os.listdir(dir_path)
-
-                    if len(song_inputs) != len(downloaded_contents):
-                        write_unavailable_songs(song_inputs, downloaded_contents, dir_path)
+                dir_path = os.path.join(track_store.FILES_DIR, dir_filename)
 
-                zip_buffer = io.BytesIO()
-                with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-                    for root, dirs, files in os.walk(r_dir_path):
-                        for file in files:
-                            file_path = os.path.join(root, file)
-                            zip_file.write(file_path, os.path.relpath(file_path, r_dir_path))
+                r_job_id, r_dir_path, r_file_name = await run_blocking(download_song_fragment, dir_path, song_inputs,
+                                                                         f_id=f'sp_album__{album_id}',
+                                                                         audio_format=get_audio_format(request))
 
-                zip_buffer.seek(0)
+                # Returns right away - the job page follows the progress and hands out the archive
+                return redirect('job', job_id=r_job_id)
 
-                response = HttpResponse(zip_buffer, 'application/zip')
-                response['Content-Disposition'] = f'attachment; filename={r_file_name}.zip'
-
-                return response
 
+        # Search the songs on youtube in the background while the user looks at the list
+        await run_blocking(start_resolution, f'sp_album__{album_id}', album_songs)
 
         return render(request, 'webpage/spotify album.html',
                       {'link': link, 'link_type': 'spotify',
@@ -219,14 +190,15 @@ def spotify_album(request):
         return redirect('home')
 
 
-def spotify_track(request):
+@spotify_async.with_session
+async def spotify_track(request):
     """Spotify track page"""
     # From Spotify playlist listing page
     api_link = request.GET.get('api_link')
 
     # From home page
-    link = request.session.get('link', '')
-    token = get_spotify_token()
+    link = await request.session.aget('link', '')
+    token = await aget_spotify_token()
 
     if api_link:
         # got from listing
@@ -236,25 +208,98 @@ def spotify_track(request):
         parsed_link = urlparse(link)
         track_id = parsed_link.path.split('/')[-1]
 
-    track_info = get_track_info(token=token, track_id=track_id)
+    track_info = await spotify_async.get_track_info(token=token, track_id=track_id)
 
     if request.method == "POST":
         file_name = request.POST.get('filenameinput')
         track_id_ip = request.POST.get('track_id_input')
         file_name = fix_filename(file_name)
-        yt_url = get_youtube_url(file_name)
-        yt = YouTube(yt_url)
-
-        song_to_download, filepath = download_song(file_name, yt, f_id=f'sp_track__{track_id_ip}')
-        response = FileResponse(open(os.path.join(filepath, song_to_download), 'rb'),
-                                as_attachment=True, filename=song_to_download)
+        # Youtube is searched only if the track isn't already in the track store
+        duration = round(track_info['duration_ms'] / 1000) if track_info and track_info.get('track_id') == track_id_ip else None
+        file_log = await run_blocking(download_song, file_name, None, f_id=f'sp_track__{track_id_ip}',
+                                      audio_format=get_audio_format(request), duration=duration)
 
-        return response
+        return redirect_to_file(request, file_log)
 
     return render(request, 'webpage/spotify track.html',
                   {'track': track_info})
 
 
+def job(request, job_id):
+    """Playlist/album download progress page"""
+    if get_job_status(job_id) is None:
+        messages.info(request, 'Download expired! Try again')
+        return redirect('home')
+
+    return render(request, 'webpage/job.html', {'job_id': job_id})
+
+
+async def job_status(request, job_id):
+    """
+    Long-poll endpoint with the progress of a playlist/album job.
+    Responds as soon as the progress differs from the 'done' GET param
+    (or after LONG_POLL_TIMEOUT seconds). Waiting holds no worker thread.
+    """
+    seen = request.GET.get('done', '')
+    status = await run_blocking(get_job_status, job_id)
+
+    for _ in range(LONG_POLL_TIMEOUT // LONG_POLL_INTERVAL):
+        if status is None or status['status'] not in ('pending', 'finishing') or str(status['done']) != seen:
+            break
+        await asyncio.sleep(LONG_POLL_INTERVAL)
+        status = await run_blocking(get_job_status, job_id)
+
+    if status is None:
+        return JsonResponse({'status': 'expired'}, status=404)
+
+    return JsonResponse(status)
+
+
+def job_download(request, job_id):
+    """Sends the archive of a finished playlist/album job"""
+    job = DownloadJob.object.select_related('log').filter(job_id=job_id, status='ready').first()
+    if job is None:
+        messages.info(request, 'Download not ready or expired! Try again')
+        return redirect('home')
+    job_log = job.log
+
+    # Built by tasks.finish_download - served with range support so interrupted downloads can resume
+    zip_path = archive_path(job_log.file_path)
+    if not os.path.exists(zip_path):
+        messages.info(request, 'Download expired! Try again')
+        return redirect('home')
+    return file_response(request, zip_path, f'{get_filename(job_log.file_path)}.zip', 'application/zip')
+
+
+def redirect_to_file(request, file_log):
+    """
+    Redirects to the download url of a single file (home page if it could not be downloaded)
+    """
+    if file_log is None:
+        messages.info(request, 'Unable to download! Try again')
+        return redirect('home')
+
+    return redirect('file download', file_id=file_log.pk)
+
+
+def file_download(request, file_id):
+    """Sends a downloaded audio file (supports ranges so that interrupted downloads can resume)"""
+    file_log = VideoLog.object.filter(pk=file_id).exclude(file_type='directory').first()
+    if file_log is None or not os.path.exists(os.path.join(file_log.file_path, file_log.file_name)):
+        messages.info(request, 'Download expired! Try again')
+        return redirect('home')
+
+    return file_response(request, os.path.join(file_log.file_path, file_log.file_name), file_log.file_name)
+
+
+def rate_limits(request):
+    """Rate limit metrics of youtube/Spotify calls as JSON (staff only)"""
+    if not request.user.is_staff:
+        return HttpResponse(status=403)
+
+    return JsonResponse(get_rate_limit_metrics())
+
+
 def info_page(request):
     """'How to ?' page"""
     return render(request, 'webpage/info.html')